@@ -0,0 +1,236 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+# vim:ts=4:sw=4:softtabstop=4:smarttab:expandtab
+
+"""Benchmark the merge engines on a synthetic corpus, outside of Sigil.
+
+    $ python benchmark.py --files 50 --size 200 --depth 3 --fragmentation 0.6 -o bench.json
+
+Every engine/backend configuration is run in a freshly spawned worker process
+(not forked, so peak RSS is its own) over the same generated XHTML files, through
+MarkupParser.process() with an Instrument, and the results are written as JSON:
+files/sec, MB/sec, peak RSS, the time spent in each phase (parse, merge,
+serialise; the stream backend and the patch output do all three at once) and
+the Instrument's counters. With --check the run fails if the configurations disagree on the number of
+occurrences merged, if a merged bs4 tree has inconsistent links, or if the
+patch output differs from the stream backend's by a single byte."""
+
+from __future__ import unicode_literals, division, absolute_import, print_function
+
+import sys
+import json
+import hashlib
+import time
+import random
+import argparse
+import platform
+import multiprocessing
+from datetime import datetime
+from concurrent.futures import ProcessPoolExecutor
+
+try:
+    import resource
+except ImportError:  # Windows
+    resource = None
+
+from parsing_engine import MarkupParser, Instrument, ENGINE_VERSION, check_tree
+
+
+CONFIGS = [
+    ("bs4", "classic"),
+    ("bs4", "linear"),
+    ("bs4", "postorder"),
+    ("lxml", None),
+    ("stream", None),
+    # criteria['output'] = 'patch', which splices the merges into the source
+    # whatever the backend
+    ("patch", None),
+]
+
+HEAD = """<?xml version="1.0" encoding="utf-8"?>
+<!DOCTYPE html>
+<html xmlns="http://www.w3.org/1999/xhtml" xmlns:epub="http://www.idpf.org/2007/ops">
+<head>
+<title>Chapter {}</title>
+</head>
+<body>
+"""
+WORDS = "lorem ipsum dolor sit amet consectetur adipiscing elit sed do eiusmod tempor".split()
+CLASSES = ["calibre1", "calibre2", "calibre12", "italic", "bold"]
+
+
+def fragment(rng, depth, fragmentation):
+    """Markup of one run of text, split into adjacent mergeable spans with
+    probability fragmentation and wrapped in depth levels of nesting."""
+    cls = rng.choice(CLASSES)
+    words = [rng.choice(WORDS) for _ in range(rng.randint(2, 12))]
+    if rng.random() < fragmentation:
+        pieces = ['<span class="{}">{} </span>'.format(cls, w) for w in words]
+    else:
+        pieces = ['<span class="{}">{} </span>'.format(cls, " ".join(words))]
+    markup = "".join(pieces)
+    for level in range(depth):
+        tag = "span" if level % 2 else "i"
+        markup = '<{0} class="d{1}">{2}</{0}>'.format(tag, level, markup)
+    return markup
+
+
+def make_document(rng, number, size, depth, fragmentation):
+    """Synthetic XHTML chapter of roughly size bytes."""
+    parts = [HEAD.format(number)]
+    length = len(parts[0])
+    while length < size:
+        para = ['<p class="para">']
+        for _ in range(rng.randint(3, 10)):
+            para.append(fragment(rng, rng.randint(0, depth), fragmentation))
+            para.append(" ")
+        para.append("</p>\n")
+        para = "".join(para)
+        parts.append(para)
+        length += len(para)
+    parts.append("</body>\n</html>\n")
+    return "".join(parts)
+
+
+def make_corpus(files, size, depth, fragmentation, seed):
+    rng = random.Random(seed)
+    return [make_document(rng, i, size, depth, fragmentation) for i in range(files)]
+
+
+def peak_rss_kb():
+    if resource is None:
+        return None
+    rss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    # bytes on macOS, kilobytes elsewhere
+    return rss // 1024 if sys.platform == "darwin" else rss
+
+
+def run_config(backend, engine, criteria, corpus, repeat, check=False):
+    """Run one configuration over the corpus; executed in a worker process.
+    With check, a digest of the merged markup is taken (outside of the
+    timings) and, for bs4, the merged trees are checked for inconsistent
+    links in a separate pass."""
+    if backend == "patch":
+        criteria = dict(criteria, output="patch")
+    else:
+        criteria = dict(criteria, backend=backend)
+    if engine is not None:
+        criteria["engine"] = engine
+    instrument = Instrument()
+    parser = MarkupParser(criteria, instrument)
+    digest = hashlib.sha1()
+    checking = 0.0
+    start = time.perf_counter()
+    for _ in range(repeat):
+        for number, html in enumerate(corpus):
+            merged, occurrences = parser.process(html, number)
+            if check:
+                t = time.perf_counter()
+                digest.update((html if merged is None else merged).encode("utf-8"))
+                checking += time.perf_counter() - t
+    total = time.perf_counter() - start - checking
+    problems = 0
+    if check and backend == "bs4" and not parser.dry_run:
+        for html in corpus:
+            parser.wipml = html
+            problems += len(check_tree(parser.merge(parser.parse())))
+    totals = instrument.totals()
+    size = sum(len(html.encode("utf-8")) for html in corpus) * repeat
+    return {
+        "backend": backend,
+        "engine": engine,
+        "seconds": total,
+        "files_per_sec": len(corpus) * repeat / total,
+        "mb_per_sec": size / total / (1024 * 1024),
+        "peak_rss_kb": peak_rss_kb(),
+        "phases": dict((phase, seconds) for phase, seconds in totals["phases"].items() if seconds),
+        "counters": dict((counter, totals[counter] // repeat) for counter in Instrument.COUNTERS),
+        "occurrences": totals["merges"] // repeat,
+        "short_circuited": parser.short_circuited // repeat,
+        "tree_problems": problems,
+        "output_sha1": digest.hexdigest() if check else None,
+    }
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--files", type=int, default=20, help="number of files")
+    parser.add_argument("--size", type=int, default=100, help="approximate size of each file in KB")
+    parser.add_argument("--depth", type=int, default=2, help="maximum nesting depth around the spans")
+    parser.add_argument("--fragmentation", type=float, default=0.5, help="share of text runs split into adjacent spans (0-1)")
+    parser.add_argument("--seed", type=int, default=1)
+    parser.add_argument("--repeat", type=int, default=1, help="passes over the corpus per configuration")
+    parser.add_argument("--tag", default="span")
+    parser.add_argument("--attrib", default="class")
+    parser.add_argument("--srch-str", default="calibre.*|italic|bold")
+    parser.add_argument("--srch-method", default="regex", choices=("normal", "regex"))
+    parser.add_argument("--prefilter", action="store_true", help="include the prefilter scan")
+    parser.add_argument("--dry-run", action="store_true", help="only count the merges, as a dry run does")
+    parser.add_argument("--config", action="append", metavar="BACKEND[:ENGINE]", help="only run these configurations")
+    parser.add_argument("--check", action="store_true", help="fail if configurations merge different numbers of occurrences, leave broken trees or patch and stream outputs differ")
+    parser.add_argument("-o", "--output", help="write the JSON report here instead of stdout")
+    args = parser.parse_args(argv)
+
+    configs = CONFIGS
+    if args.config:
+        configs = [tuple(c.split(":", 1)) if ":" in c else (c, None) for c in args.config]
+    criteria = {
+        "action": "merge",
+        "tag": args.tag or None,
+        "attrib": args.attrib or None,
+        "srch_str": args.srch_str if args.attrib else None,
+        "srch_method": args.srch_method,
+        "prefilter": args.prefilter,
+        "dry_run": args.dry_run,
+    }
+    corpus = make_corpus(args.files, args.size * 1024, args.depth, args.fragmentation, args.seed)
+    report = {
+        "timestamp": datetime.now().isoformat(),
+        "python": platform.python_version(),
+        "platform": platform.platform(),
+        "engine_version": ENGINE_VERSION,
+        "criteria": criteria,
+        "corpus": {
+            "files": args.files,
+            "bytes": sum(len(html.encode("utf-8")) for html in corpus),
+            "depth": args.depth,
+            "fragmentation": args.fragmentation,
+            "seed": args.seed,
+        },
+        "results": [],
+    }
+    for backend, engine in configs:
+        # A fresh process per configuration keeps peak RSS figures separate;
+        # a forked one would start with this process's high-water mark
+        with ProcessPoolExecutor(1, mp_context=multiprocessing.get_context("spawn")) as pool:
+            result = pool.submit(run_config, backend, engine, criteria, corpus, args.repeat, args.check).result()
+        report["results"].append(result)
+        print(
+            "{:>6} {:<9} {:8.1f} files/s {:7.2f} MB/s  {} occurrences".format(
+                backend, engine or "", result["files_per_sec"], result["mb_per_sec"], result["occurrences"]
+            ),
+            file=sys.stderr,
+        )
+
+    data = json.dumps(report, indent=2)
+    if args.output:
+        with open(args.output, "w", encoding="utf-8") as f:
+            f.write(data)
+    else:
+        print(data)
+
+    if args.check and len(set(r["occurrences"] for r in report["results"])) > 1:
+        print("Configurations disagree on the number of occurrences!", file=sys.stderr)
+        return 1
+    if args.check and any(r["tree_problems"] for r in report["results"]):
+        print("Merging left inconsistent bs4 trees!", file=sys.stderr)
+        return 1
+    digests = dict((r["backend"], r["output_sha1"]) for r in report["results"] if r["backend"] in ("stream", "patch"))
+    if args.check and len(digests) == 2 and digests["stream"] != digests["patch"]:
+        print("The patch output differs from the stream backend's!", file=sys.stderr)
+        return 1
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
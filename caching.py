@@ -0,0 +1,204 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+# vim:ts=4:sw=4:softtabstop=4:smarttab:expandtab
+
+from __future__ import unicode_literals, division, absolute_import, print_function
+
+import os
+import json
+import hashlib
+
+from parsing_engine import ENGINE_VERSION
+
+
+CACHE_DIR = "cache"
+CACHE_MAX_BYTES = 64 * 1024 * 1024
+RUN_MANIFEST = "last_run.json"
+
+# Criteria keys that only steer a run and never change a merge result
+RUN_ONLY_KEYS = (
+    "html",
+    "no_select",
+    "parallel",
+    "jobs",
+    "prefilter",
+    "bypass_cache",
+    "instrument",
+    "incremental",
+)
+
+# Criteria values that are the engine's defaults: the same as leaving the key
+# out, so the GUI (which sets them all) and headless.json (which may not)
+# share cache entries and run manifests. dry_run true stays in the digest:
+# dry run entries hold no markup.
+DEFAULT_CRITERIA = {
+    "dry_run": False,
+    "class_as_set": False,
+    "coalesce_text": False,
+    "engine": "classic",
+    "backend": "bs4",
+    "output": "serialise",
+}
+# The same for the keys of criteria['rules'] entries
+DEFAULT_RULE = {"tag": None, "attrib": None, "srch_str": None, "srch_method": "normal"}
+# Criteria a 'rules' list replaces
+RULE_CRITERIA = ("tag", "attrib", "srch_str", "srch_method")
+
+
+def criteria_digest(criteria):
+    """Hash of the result-affecting criteria and the engine version."""
+    normalised = {
+        k: v
+        for k, v in criteria.items()
+        if k not in RUN_ONLY_KEYS and (k not in DEFAULT_CRITERIA or v != DEFAULT_CRITERIA[k])
+    }
+    if isinstance(normalised.get("rules"), list):
+        for k in RULE_CRITERIA:
+            normalised.pop(k, None)
+        normalised["rules"] = [
+            {k: v for k, v in rule.items() if k not in DEFAULT_RULE or v != DEFAULT_RULE[k]}
+            if isinstance(rule, dict)
+            else rule
+            for rule in normalised["rules"]
+        ]
+    data = json.dumps(
+        [ENGINE_VERSION, normalised], sort_keys=True, ensure_ascii=False, default=str
+    )
+    return hashlib.sha256(data.encode("utf-8")).hexdigest()
+
+
+class ResultCache(object):
+    """
+    On-disk cache of merge results, kept in a 'cache' folder inside the plugin's
+    prefs folder (next to headless.json). Entries are keyed by a hash of the
+    input (x)html, the normalised criteria and ENGINE_VERSION, and hold the
+    merged markup (None when nothing changed) and the occurrences count.
+
+    self.folder             : folder holding one json file per entry
+    self.digest             : criteria_digest() of the run's criteria
+    self.max_bytes          : size the cache is pruned back to, least recently used first
+    self.hits/self.misses   : lookups answered/not answered from the cache
+    """
+
+    def __init__(self, prefs_folder, criteria, max_bytes=CACHE_MAX_BYTES):
+        self.folder = os.path.join(prefs_folder, CACHE_DIR)
+        self.digest = criteria_digest(criteria)
+        self.max_bytes = max_bytes
+        self.hits = 0
+        self.misses = 0
+        if not os.path.isdir(self.folder):
+            os.makedirs(self.folder)
+
+    def path(self, html):
+        key = hashlib.sha256(self.digest.encode("ascii"))
+        key.update(html.encode("utf-8"))
+        return os.path.join(self.folder, key.hexdigest() + ".json")
+
+    def get(self, html):
+        """Return the cached (html, occurrences) for html, or None."""
+        path = self.path(html)
+        try:
+            with open(path, "r", encoding="utf-8") as f:
+                entry = json.load(f)
+            # Mark as recently used for pruning
+            os.utime(path, None)
+        except (OSError, ValueError):
+            self.misses += 1
+            return None
+        self.hits += 1
+        if entry["html"] is None:
+            return html, entry["occurrences"]
+        return entry["html"], entry["occurrences"]
+
+    def put(self, html, new_html, occurrences):
+        entry = {"html": new_html if occurrences else None, "occurrences": occurrences}
+        path = self.path(html)
+        tmp = "{}.{}.tmp".format(path, os.getpid())
+        try:
+            with open(tmp, "w", encoding="utf-8") as f:
+                json.dump(entry, f, ensure_ascii=False)
+            os.replace(tmp, path)
+        except OSError:
+            print("Couldn't write to the result cache!")
+
+    def prune(self):
+        """Evict least recently used entries until the cache fits max_bytes."""
+        entries = []
+        total = 0
+        for entry in os.scandir(self.folder):
+            if not entry.name.endswith(".json"):
+                continue
+            st = entry.stat()
+            entries.append((st.st_mtime, st.st_size, entry.path))
+            total += st.st_size
+        if total <= self.max_bytes:
+            return
+        entries.sort()
+        for mtime, size, path in entries:
+            try:
+                os.remove(path)
+            except OSError:
+                continue
+            total -= size
+            if total <= self.max_bytes:
+                break
+
+
+def content_hash(html):
+    return hashlib.sha256(html.encode("utf-8")).hexdigest()
+
+
+class RunManifest(object):
+    """
+    Content hashes of the text files as the last run left them, kept with the
+    criteria_digest() of that run in 'last_run.json' in the plugin's prefs
+    folder. A file whose content still has its recorded hash was merged with
+    the same criteria and hasn't been edited since, so it can be skipped.
+
+    self.path       : the json file
+    self.digest     : criteria_digest() of this run's criteria
+    self.hashes     : href -> content hash (the last run's, if it used the same criteria)
+    self.incremental: criteria['incremental'], skip unchanged files
+    self.skipped    : files skipped
+    """
+
+    def __init__(self, prefs_folder, criteria):
+        self.path = os.path.join(prefs_folder, RUN_MANIFEST)
+        self.digest = criteria_digest(criteria)
+        self.hashes = {}
+        self.incremental = criteria.get("incremental", False)
+        self.skipped = 0
+        try:
+            with open(self.path, "r", encoding="utf-8") as f:
+                manifest = json.load(f)
+        except (OSError, ValueError):
+            return
+        if manifest.get("digest") == self.digest:
+            self.hashes = manifest["files"]
+
+    def skip(self, href, html):
+        """Can href be skipped (incremental run, and html is what the last run
+        left in it)? Otherwise html becomes href's recorded content, until
+        record() or forget()."""
+        digest = content_hash(html)
+        if self.incremental and self.hashes.get(href) == digest:
+            self.skipped += 1
+            return True
+        self.hashes[href] = digest
+        return False
+
+    def record(self, href, html):
+        """Record the markup written back to href."""
+        self.hashes[href] = content_hash(html)
+
+    def forget(self, href):
+        self.hashes.pop(href, None)
+
+    def save(self):
+        tmp = "{}.{}.tmp".format(self.path, os.getpid())
+        try:
+            with open(tmp, "w", encoding="utf-8") as f:
+                json.dump({"digest": self.digest, "files": self.hashes}, f)
+            os.replace(tmp, self.path)
+        except OSError:
+            print("Couldn't save the run manifest!")
@@ -0,0 +1,349 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+# vim:ts=4:sw=4:softtabstop=4:smarttab:expandtab
+
+"""Merge adjacent tags in books outside of Sigil.
+
+    $ python cli.py --criteria headless.json --jobs 4 --output merged/ book.epub unpacked_book/ chapters/
+
+Every input is a zipped EPUB, an unpacked EPUB (a folder with
+META-INF/container.xml, whose OPF manifest lists the text files) or a plain
+folder of (x)html files. They are processed with the same engine and
+headless.json criteria as a headless plugin run, in place or into copies in
+the output folder."""
+
+from __future__ import unicode_literals, division, absolute_import, print_function
+
+import os
+import sys
+import copy
+import json
+import shutil
+import struct
+import zipfile
+import argparse
+import posixpath
+from collections import deque
+from functools import partial
+from urllib.parse import unquote
+
+from lxml import etree
+
+from parsing_engine import MarkupParser, Instrument, process_documents, worker_pool
+from caching import ResultCache
+
+
+TEXT_MEDIA_TYPE = "application/xhtml+xml"
+TEXT_EXTENSIONS = (".xhtml", ".html", ".htm")
+COPY_CHUNK = 1024 * 1024
+# Local file header: signature ... file name length, extra field length
+_local_header = struct.Struct("<4s22xHH")
+# Books started (their text files handed to the worker pool) ahead of the
+# one being written
+BOOKS_AHEAD = 8
+# Errors that make an input book unreadable
+READ_ERRORS = (OSError, KeyError, zipfile.BadZipFile, etree.XMLSyntaxError)
+
+
+def manifest_text_files(read):
+    """Paths (relative to the book's root, with '/' separators) of the text
+    files in an EPUB's OPF manifest, in manifest order. read(path) returns the
+    bytes of one of the book's files."""
+    container = etree.fromstring(read("META-INF/container.xml"))
+    opf_path = container.find(".//{*}rootfile").get("full-path")
+    opf = etree.fromstring(read(opf_path))
+    opf_dir = posixpath.dirname(opf_path)
+    paths = []
+    for item in opf.iterfind(".//{*}manifest/{*}item"):
+        if item.get("media-type") == TEXT_MEDIA_TYPE:
+            href = unquote(item.get("href").split("#", 1)[0])
+            paths.append(posixpath.normpath(posixpath.join(opf_dir, href)))
+    return paths
+
+
+def local_path(folder, path):
+    return os.path.join(folder, *path.split("/"))
+
+
+def folder_text_files(folder):
+    """Paths (relative to folder, with '/' separators) of the text files of a
+    book folder."""
+    if os.path.isfile(local_path(folder, "META-INF/container.xml")):
+
+        def read(path):
+            with open(local_path(folder, path), "rb") as f:
+                return f.read()
+
+        return manifest_text_files(read)
+    paths = []
+    for dirpath, dirnames, filenames in os.walk(folder):
+        dirnames.sort()
+        for name in sorted(filenames):
+            if name.lower().endswith(TEXT_EXTENSIONS):
+                path = os.path.relpath(os.path.join(dirpath, name), folder)
+                paths.append(path.replace(os.sep, "/"))
+    return paths
+
+
+def read_documents(folder, paths):
+    for path in paths:
+        with open(local_path(folder, path), "r", encoding="utf-8", newline="") as f:
+            yield path, f.read()
+
+
+def process_folder(parser, folder, cache, results=None):
+    """Merge the text files of a book folder in place (a dry run only counts).
+    results are those of process_documents() for them if already under way.
+    Returns the number of occurrences changed and of files that could not be
+    processed."""
+    totals = errors = 0
+    if results is None:
+        results = process_documents(parser, read_documents(folder, folder_text_files(folder)), 1, cache)
+    for path, html, occurrences, error in results:
+        if error is not None:
+            print("{} {}! {}.".format("Error parsing", path, "File skipped"))
+            errors += 1
+            continue
+        totals += occurrences
+        if occurrences and parser.dry_run:
+            print("{} {}:   {}".format("Occurrences that would be changed in", path, int(occurrences)))
+        elif occurrences:
+            with open(local_path(folder, path), "w", encoding="utf-8", newline="") as f:
+                f.write(html)
+            print("{} {}:   {}".format("Occurrences found/changed in", path, int(occurrences)))
+    return totals, errors
+
+
+def epub_members(src):
+    """Members of an open EPUB zip, mimetype first, and the names of its
+    text files."""
+    infos = src.infolist()
+    infos.sort(key=lambda info: info.filename != "mimetype")
+    return infos, set(manifest_text_files(src.read))
+
+
+def epub_documents(src, infos, texts):
+    return (
+        (info.filename, str(src.read(info), "utf-8"))
+        for info in infos
+        if info.filename in texts
+    )
+
+
+def copy_member(source, info, out):
+    """Copy a member of the zip open as the binary file source into the
+    ZipFile out as it is stored, without decompressing and recompressing it.
+    Returns False (having written nothing) if that can't be done."""
+    try:
+        source.seek(info.header_offset)
+        signature, name_length, extra_length = _local_header.unpack(
+            source.read(_local_header.size)
+        )
+        if signature != b"PK\x03\x04" or info.flag_bits & 0x01:
+            # Not a local file header, or encrypted
+            return False
+        source.seek(name_length + extra_length, os.SEEK_CUR)
+        # zipfile has no public API for this: write the entry the way
+        # ZipFile.writestr does, with the compressed bytes copied through
+        fp = out.fp
+        zinfo = copy.copy(info)
+        # CRC and sizes are known: no data descriptor after the data
+        zinfo.flag_bits &= ~0x08
+        zinfo.header_offset = fp.tell()
+        fp.write(zinfo.FileHeader())
+    except (AttributeError, struct.error, OSError):
+        return False
+    remaining = info.compress_size
+    while remaining:
+        data = source.read(min(remaining, COPY_CHUNK))
+        if not data:
+            raise zipfile.BadZipFile("Truncated member {}".format(info.filename))
+        fp.write(data)
+        remaining -= len(data)
+    out.filelist.append(zinfo)
+    out.NameToInfo[zinfo.filename] = zinfo
+    out.start_dir = fp.tell()
+    out._didModify = True
+    return True
+
+
+def process_epub(parser, source, destination, cache, results=None):
+    """Merge a zipped EPUB into destination (which may be source), streaming
+    the text files from one zip to the other. Other members, and text files
+    with nothing merged, are copied as they are stored; mimetype goes first,
+    stored. results are those of process_documents() for the text files if
+    already under way. Returns the number of occurrences changed and of text
+    files that could not be processed."""
+    totals = errors = 0
+    tmp = destination + ".tmp"
+    with zipfile.ZipFile(source) as src, open(source, "rb") as raw:
+        infos, texts = epub_members(src)
+        if results is None:
+            results = process_documents(parser, epub_documents(src, infos, texts), 1, cache)
+        try:
+            with zipfile.ZipFile(tmp, "w") as out:
+                for info in infos:
+                    if info.filename == "mimetype":
+                        out.writestr(info, src.read(info), zipfile.ZIP_STORED)
+                        continue
+                    if info.filename in texts:
+                        path, html, occurrences, error = next(results)
+                        if error is not None:
+                            print("{} {}! {}.".format("Error parsing", path, "File skipped"))
+                            errors += 1
+                        elif occurrences:
+                            totals += occurrences
+                            out.writestr(info, html.encode("utf-8"))
+                            print("{} {}:   {}".format("Occurrences found/changed in", path, int(occurrences)))
+                            continue
+                    if not copy_member(raw, info, out):
+                        out.writestr(info, src.read(info))
+        except BaseException:
+            os.remove(tmp)
+            raise
+    os.replace(tmp, destination)
+    return totals, errors
+
+
+def count_epub(parser, source, cache, results=None):
+    """Dry run of process_epub: count the merges in a zipped EPUB's text
+    files without writing anything."""
+    totals = errors = 0
+    with zipfile.ZipFile(source) as src:
+        if results is None:
+            results = process_documents(parser, epub_documents(src, *epub_members(src)), 1, cache)
+        for path, html, occurrences, error in results:
+            if error is not None:
+                print("{} {}! {}.".format("Error parsing", path, "File skipped"))
+                errors += 1
+            elif occurrences:
+                totals += occurrences
+                print("{} {}:   {}".format("Occurrences that would be changed in", path, int(occurrences)))
+    return totals, errors
+
+
+def start_input(parser, path, output, pool, cache):
+    """Start on one input book, merged in place when output is None (dry runs
+    only count, whatever output is). With a pool its text files are read
+    and handed to the pool now, so that several books can be in the works at
+    once. Returns a function that finishes the book, writing it and
+    reporting on it, and returns the number of occurrences changed and of
+    files that could not be processed."""
+    is_folder = os.path.isdir(path)
+    if is_folder and output is not None and not parser.dry_run:
+        target = os.path.join(output, os.path.basename(os.path.normpath(path)))
+        shutil.copytree(path, target)
+        path = target
+    results = None
+    if pool is not None:
+        if is_folder:
+            documents = read_documents(path, folder_text_files(path))
+            results = process_documents(parser, documents, cache=cache, pool=pool)
+        else:
+            with zipfile.ZipFile(path) as src:
+                documents = epub_documents(src, *epub_members(src))
+                results = process_documents(parser, documents, cache=cache, pool=pool)
+    if is_folder:
+        return partial(process_folder, parser, path, cache, results)
+    if parser.dry_run:
+        return partial(count_epub, parser, path, cache, results)
+    destination = path
+    if output is not None:
+        destination = os.path.join(output, os.path.basename(path))
+    return partial(process_epub, parser, path, destination, cache, results)
+
+
+def process_inputs(parser, paths, output, pool, cache):
+    """Merge the input books in turn, yielding (path, occurrences changed,
+    files that could not be processed, error reading the book or None) as
+    each is finished. With a pool the next BOOKS_AHEAD books are started
+    before one is finished, so that their text files are merged while it is
+    being written and small books don't leave workers idle."""
+    started = deque()
+    paths = iter(paths)
+    while True:
+        while len(started) < (BOOKS_AHEAD if pool is not None else 1):
+            path = next(paths, None)
+            if path is None:
+                break
+            try:
+                started.append((path, start_input(parser, path, output, pool, cache), None))
+            except READ_ERRORS as e:
+                started.append((path, None, e))
+        if not started:
+            return
+        path, finish, error = started.popleft()
+        print("Processing {}".format(path))
+        if error is None:
+            try:
+                occurrences, failed = finish()
+            except READ_ERRORS as e:
+                error = e
+        if error is not None:
+            yield path, 0, 0, error
+        else:
+            yield path, occurrences, failed, None
+
+
+def main(argv=None):
+    ap = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    ap.add_argument("inputs", nargs="+", metavar="BOOK", help="EPUB file, unpacked EPUB or folder of (x)html files")
+    ap.add_argument("-c", "--criteria", required=True, help="headless.json-style criteria file")
+    ap.add_argument("-j", "--jobs", type=int, default=1, help="worker processes shared by all the books (0 = one per CPU)")
+    ap.add_argument("-o", "--output", help="write merged copies here instead of changing the inputs")
+    ap.add_argument("--cache", metavar="FOLDER", help="reuse results cached in FOLDER (as in the plugin prefs folder)")
+    ap.add_argument("-n", "--dry-run", action="store_true", help="only count the merges, change nothing")
+    args = ap.parse_args(argv)
+
+    with open(args.criteria, "r", encoding="utf-8") as f:
+        criteria = json.load(f)
+    if args.dry_run:
+        criteria["dry_run"] = True
+    instrument = None
+    if criteria.get("instrument", False):
+        instrument = Instrument()
+    try:
+        parser = MarkupParser(criteria, instrument)
+    except ValueError as e:
+        print("{}: {}".format("Invalid criteria", e))
+        return 2
+    cache = None
+    if args.cache is not None and not criteria.get("bypass_cache", False):
+        cache = ResultCache(args.cache, criteria)
+    if args.output is not None and not parser.dry_run and not os.path.isdir(args.output):
+        os.makedirs(args.output)
+
+    # One pool of workers for the whole run, shared by all the books
+    pool = worker_pool(parser, args.jobs)
+    totals = errors = 0
+    try:
+        for path, occurrences, failed, error in process_inputs(parser, args.inputs, args.output, pool, cache):
+            if error is not None:
+                print("{} {}! {}".format("Error reading", path, error))
+                errors += 1
+                continue
+            totals += occurrences
+            errors += failed
+    finally:
+        if pool is not None:
+            pool.shutdown()
+
+    if parser.dry_run:
+        print("{}: {}".format("Dry run - total occurrences that would be changed", totals))
+    else:
+        print("{}: {}".format("Total occurrences found/changed", totals))
+    if parser.short_circuited:
+        print("{}: {}".format("Files skipped without parsing (nothing to merge)", parser.short_circuited))
+    if cache is not None:
+        print("{}: {}".format("Results reused from cache", cache.hits))
+        cache.prune()
+    if instrument is not None:
+        for label, value in instrument.summary():
+            print("{}: {}".format(label, value))
+        if isinstance(criteria["instrument"], str):
+            instrument.dump(criteria["instrument"])
+    return 1 if errors else 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -11,10 +11,11 @@ import json
 from pathlib import Path
 
 from utilities import UpdateChecker, taglist, combobox_defaults, remove_dupes
-from parsing_engine import MarkupParser
+from parsing_engine import MarkupParser, Instrument, process_documents
+from caching import ResultCache, RunManifest
 
-from plugin_utils import Qt, QtCore, QtGui, QtWidgets, QAction
-from plugin_utils import PluginApplication, iswindows, _t  # , Signal, Slot, loadUi
+from plugin_utils import Qt, QtCore, QtGui, QtWidgets, QAction, Signal
+from plugin_utils import PluginApplication, iswindows, _t  # , Slot, loadUi
 
 
 DEBUG = 0
@@ -27,6 +28,13 @@ if DEBUG:
 BAIL_OUT = False
 PROCESSED = False
 
+# The log panel is updated with the buffered lines at most this often (ms)
+LOG_FLUSH_INTERVAL = 100
+
+# Criteria that only apply to the GUI run they are ticked for, never saved to
+# headless.json (a saved dry run would make every Automate run a no-op)
+RUN_ONLY_CRITERIA = ("dry_run", "instrument")
+
 
 def launch_gui(bk, prefs):
 
@@ -46,6 +54,57 @@ def launch_gui(bk, prefs):
     return win.getAbort()
 
 
+class MergeWorker(QtCore.QObject):
+    """Merges the documents off the GUI thread. Emits progress after every
+    file and finished (with whether it was cancelled) at the end; the results
+    are left in self.results for the GUI thread to apply to the book."""
+
+    progress = Signal(int, str, int, bool)
+    finished = Signal(bool)
+
+    def __init__(self, parser, documents, cache=None):
+        super(MergeWorker, self).__init__()
+        self.parser = parser
+        self.documents = documents
+        self.cache = cache
+        self.results = []
+        self.cancelled = False
+
+    def cancel(self):
+        self.cancelled = True
+
+    def run(self):
+        documents = (((ident, href), html) for ident, href, html in self.documents)
+        # Retrieve the new markup and the number of occurrences changed
+        results = process_documents(self.parser, documents, 1, self.cache)
+        for number, ((ident, href), html, occurrences, error) in enumerate(results, 1):
+            error = error is not None
+            self.results.append((ident, href, html, occurrences, error))
+            self.progress.emit(number, href, occurrences, error)
+            if self.cancelled:
+                break
+        self.finished.emit(self.cancelled)
+
+
+class UpdateWorker(QtCore.QObject):
+    """Runs the (blocking) online update check off the GUI thread and emits
+    finished with UpdateChecker.update_info()'s result, or None if the
+    check failed."""
+
+    finished = Signal(object)
+
+    def __init__(self, checker):
+        super(UpdateWorker, self).__init__()
+        self.checker = checker
+
+    def run(self):
+        try:
+            result = self.checker.update_info()
+        except Exception:
+            result = None
+        self.finished.emit(result)
+
+
 class ConfigDialog(QtWidgets.QDialog):
     def __init__(self, parent, combobox_values):
         super(ConfigDialog, self).__init__()
@@ -235,9 +294,16 @@ class guiMain(QtWidgets.QMainWindow):
         self.combobox_values = prefs["combobox_values"]
 
         self._ok_to_close = False
-        # Check online github files for newer version
-        self.update, self.newversion = self.check_for_update()
+        self._thread = None
+        self._worker = None
+        self._manifest = None
+        # Log lines (html) not yet shown in the text panel
+        self._log = []
+        self._update_thread = None
+        self._update_worker = None
         self.setup_ui()
+        # Check online github files for newer version, without holding up the window
+        self.check_for_update()
 
     def setup_ui(self):
         app = PluginApplication.instance()
@@ -270,15 +336,13 @@ class guiMain(QtWidgets.QMainWindow):
         widget.setLayout(layout)
         self.setCentralWidget(widget)
 
-        if self.update:
-            update_layout = QtWidgets.QHBoxLayout()
-            layout.addLayout(update_layout)
-            self.label = QtWidgets.QLabel()
-            self.label.setText(
-                _t("guiMain", "Plugin Update Available") + " " + str(self.newversion)
-            )
-            self.label.setStyleSheet("QLabel {{color: {};}}".format(link_color))
-            update_layout.addWidget(self.label)
+        # Shown by _update_checked() if a newer version is found
+        update_layout = QtWidgets.QHBoxLayout()
+        layout.addLayout(update_layout)
+        self.label = QtWidgets.QLabel()
+        self.label.setStyleSheet("QLabel {{color: {};}}".format(link_color))
+        self.label.setVisible(False)
+        update_layout.addWidget(self.label)
 
         action_layout = QtWidgets.QHBoxLayout()
         layout.addLayout(action_layout)
@@ -328,11 +392,39 @@ class guiMain(QtWidgets.QMainWindow):
         )
         # self.check_text.stateChanged.connect(self.update_txt_box)
         check_layout.addWidget(self.check_text)
+        self.bypass_cache = QtWidgets.QCheckBox(
+            _t("guiMain", "Bypass result cache (reprocess every file)"), self
+        )
+        check_layout.addWidget(self.bypass_cache)
+        self.incremental = QtWidgets.QCheckBox(
+            _t("guiMain", "Skip files unchanged since the last run with these criteria"),
+            self,
+        )
+        check_layout.addWidget(self.incremental)
+        self.dry_run = QtWidgets.QCheckBox(
+            _t("guiMain", "Dry run (only count the merges, change nothing)"), self
+        )
+        check_layout.addWidget(self.dry_run)
+        self.instrument = QtWidgets.QCheckBox(
+            _t("guiMain", "Report timings and counters"), self
+        )
+        check_layout.addWidget(self.instrument)
+        self.compact_log = QtWidgets.QCheckBox(
+            _t("guiMain", "Compact log (summary table at the end)"), self
+        )
+        check_layout.addWidget(self.compact_log)
 
         layout.addSpacing(10)
         self.text_panel = QtWidgets.QTextEdit()
         self.text_panel.setReadOnly(True)
         layout.addWidget(self.text_panel)
+        # Re-laying out the panel for every line is slow with many files
+        self.log_timer = QtCore.QTimer(self)
+        self.log_timer.setInterval(LOG_FLUSH_INTERVAL)
+        self.log_timer.timeout.connect(self.flush_log)
+        self.progress_bar = QtWidgets.QProgressBar(self)
+        self.progress_bar.setVisible(False)
+        layout.addWidget(self.progress_bar)
 
         layout.addSpacing(10)
         first_button_layout = QtWidgets.QHBoxLayout()
@@ -356,6 +448,14 @@ class guiMain(QtWidgets.QMainWindow):
         self.process_button.clicked.connect(self._process_clicked)
         button_layout.addWidget(self.process_button)
 
+        self.cancel_button = QtWidgets.QPushButton(_t("guiMain", "Cancel"), self)
+        self.cancel_button.setToolTip(
+            "<p>{}".format(_t("guiMain", "Stop processing without changing any files"))
+        )
+        self.cancel_button.clicked.connect(self._cancel_clicked)
+        self.cancel_button.setDisabled(True)
+        button_layout.addWidget(self.cancel_button)
+
         self.abort_button = QtWidgets.QPushButton(_t("guiMain", "Abort Changes"), self)
         self.abort_button.setToolTip(
             "<p>{}".format(_t("guiMain", "Make no changes and exit"))
@@ -433,6 +533,22 @@ class guiMain(QtWidgets.QMainWindow):
         if self.check_text.isChecked():
             criteria["no_select"] = True
 
+        criteria["bypass_cache"] = False
+        if self.bypass_cache.isChecked():
+            criteria["bypass_cache"] = True
+
+        criteria["instrument"] = False
+        if self.instrument.isChecked():
+            criteria["instrument"] = True
+
+        criteria["incremental"] = False
+        if self.incremental.isChecked():
+            criteria["incremental"] = True
+
+        criteria["dry_run"] = False
+        if self.dry_run.isChecked():
+            criteria["dry_run"] = True
+
         return (None, criteria)
 
     def _process_clicked(self):
@@ -445,7 +561,6 @@ class guiMain(QtWidgets.QMainWindow):
         self.process_button.setDisabled(True)
         PROCESSED = True
 
-        totals = 0
         self.text_panel.clear()
         self.text_panel.insertHtml(
             "<h4>{}...</h4><br>".format(_t("guiMain", "Starting"))
@@ -469,51 +584,203 @@ class guiMain(QtWidgets.QMainWindow):
             )
             return
 
+        two_up = Path(self.bk._w.plugin_dir).resolve().parents[0]
+        prefs_folder = two_up.joinpath("plugins_prefs", self.bk._w.plugin_name)
+        # Files as this run leaves them are recorded; incremental runs skip the
+        # ones unchanged since the last run with the same criteria
+        self._manifest = RunManifest(prefs_folder, criteria)
+
+        # Read the files here: the bk container is only used from the GUI thread
+        documents = []
         for ident in tuple_item:
             # Skip the ones that aren't the "Text" mimetype.
             if self.bk.id_to_mime(ident) != "application/xhtml+xml":
                 continue
             href = self.bk.id_to_href(ident)
-            # Param 1 - the contents of the (x)html file.
-            criteria["html"] = self.bk.readfile(ident)
-            if not isinstance(criteria["html"], str):
-                criteria["html"] = str(criteria["html"], "utf-8")
-
-            # Hand off the "criteria" parameters dictionary to the parsing engine
-            parser = MarkupParser(criteria)
+            # The contents of the (x)html file.
+            html = self.bk.readfile(ident)
+            if not isinstance(html, str):
+                html = str(html, "utf-8")
+            if self._manifest.skip(href, html):
+                continue
+            documents.append((ident, href, html))
+
+        # Hand off the "criteria" parameters dictionary to the parsing engine
+        # once; the same parser is reused for every file.
+        instrument = None
+        if criteria["instrument"]:
+            instrument = Instrument()
+        parser = MarkupParser(criteria, instrument)
+        # Results of earlier runs are reused unless the cache is bypassed
+        cache = None
+        if not criteria["bypass_cache"]:
+            cache = ResultCache(prefs_folder, criteria)
+        self.progress_bar.setRange(0, len(documents))
+        self.progress_bar.setValue(0)
+        self.progress_bar.setVisible(True)
+        self.cancel_button.setDisabled(False)
+        self.quit_button.setDisabled(True)
+
+        # Merge on a worker thread so the window stays responsive
+        self._thread = QtCore.QThread(self)
+        self._worker = MergeWorker(parser, documents, cache)
+        self._worker.moveToThread(self._thread)
+        self._thread.started.connect(self._worker.run)
+        self._worker.progress.connect(self._process_progress)
+        self._worker.finished.connect(self._process_finished)
+        self._thread.start()
+        self.log_timer.start()
+
+    def log(self, html):
+        """Queue html for the text panel; see flush_log()."""
+        self._log.append(html)
+
+    def flush_log(self):
+        """Append the queued log lines to the text panel in one go."""
+        if self._log:
+            self.text_panel.insertHtml("".join(self._log))
+            self._log = []
+
+    def _process_progress(self, number, href, occurrences, error):
+        self.progress_bar.setValue(number)
+        if self.compact_log.isChecked():
+            return
+        # Report whether or not changes were made (and how many)
+        if error:
+            self.log(
+                "<p>{} {}! {}.</p>\n".format(
+                    _t("guiMain", "Error parsing"),
+                    href,
+                    _t("guiMain", "File skipped"),
+                )
+            )
+            return
+        if occurrences:
+            if self._worker.parser.dry_run:
+                label = _t("guiMain", "Occurrences that would be changed in")
+            else:
+                label = _t("guiMain", "Occurrences found/changed in")
+            self.log(
+                "<p>{} {}:&#160;&#160;&#160;{}</p>".format(label, href, int(occurrences))
+            )
+        else:
+            self.log(
+                "<p>{} {}</p>\n".format(_t("guiMain", "Criteria not found in"), href)
+            )
 
-            # Retrieve the new markup and the number of occurrences changed
-            try:
-                html, occurrences = parser.processml()
-            except Exception:
-                self.text_panel.insertHtml(
-                    "<p>{} {}! {}.</p>\n".format(
-                        _t("guiMain", "Error parsing"),
-                        href,
-                        _t("guiMain", "File skipped"),
-                    )
+    def _process_finished(self, cancelled):
+        global PROCESSED
+        self._thread.quit()
+        self._thread.wait()
+        results = self._worker.results
+        short_circuited = self._worker.parser.short_circuited
+        dry_run = self._worker.parser.dry_run
+        instrument = self._worker.parser.instrument
+        cache = self._worker.cache
+        manifest = self._manifest
+        self._thread = self._worker = self._manifest = None
+        self.cancel_button.setDisabled(True)
+        self.quit_button.setDisabled(False)
+        self.progress_bar.setVisible(False)
+
+        if cancelled:
+            # Nothing has been written to the book: allow another try
+            PROCESSED = False
+            self.process_button.setDisabled(False)
+            self.log(
+                "<br><h4>{}</h4>".format(
+                    _t("guiMain", "Cancelled - no changes made to book")
                 )
-                continue
+            )
+            self.log_timer.stop()
+            self.flush_log()
+            return
 
-            # Report whether or not changes were made (and how many)
-            totals += occurrences
-            if occurrences:
-                # write changed markup back to file
-                self.bk.writefile(ident, html)
-                self.text_panel.insertHtml(
-                    "<p>{} {}:&#160;&#160;&#160;{}</p>".format(
-                        _t("guiMain", "Occurrences found/changed in"),
-                        href,
-                        int(occurrences),
-                    )
+        if self.compact_log.isChecked():
+            self.log(self.summary_table(results))
+
+        if dry_run:
+            # Nothing has been written to the book: allow a real run
+            PROCESSED = False
+            self.process_button.setDisabled(False)
+            totals = sum(result[3] for result in results if not result[4])
+            self.log(
+                "<br><h4>{}:&#160;&#160;&#160;{}</h4>".format(
+                    _t("guiMain", "Dry run - total occurrences that would be changed"),
+                    int(totals),
                 )
-            else:
-                self.text_panel.insertHtml(
-                    "<p>{} {}</p>\n".format(
-                        _t("guiMain", "Criteria not found in"), href
-                    )
+            )
+        else:
+            self.apply_results(results, manifest)
+        if manifest.incremental:
+            self.log(
+                "<br><h4>{}:&#160;&#160;&#160;{}</h4>".format(
+                    _t("guiMain", "Files skipped (unchanged since the last run)"),
+                    manifest.skipped,
+                )
+            )
+        if short_circuited:
+            self.log(
+                "<br><h4>{}:&#160;&#160;&#160;{}</h4>".format(
+                    _t("guiMain", "Files skipped without parsing (nothing to merge)"),
+                    short_circuited,
                 )
-            self.text_panel.insertPlainText("\n")
+            )
+        if cache is not None:
+            self.log(
+                "<br><h4>{}:&#160;&#160;&#160;{}</h4>".format(
+                    _t("guiMain", "Results reused from cache"), cache.hits
+                )
+            )
+            cache.prune()
+        if instrument is not None:
+            self.log("<br>")
+            for label, value in instrument.summary():
+                self.log("<p>{}:&#160;&#160;&#160;{}</p>".format(label, value))
+        self.log("<br><h4>{}</h4>".format(_t("guiMain", "Finished")))
+        self.log_timer.stop()
+        self.flush_log()
+
+    def summary_table(self, results):
+        """Html table of the files changed or skipped by errors, for the
+        compact log."""
+        rows = []
+        not_found = 0
+        for ident, href, html, occurrences, error in results:
+            if error:
+                rows.append((href, _t("guiMain", "Error parsing - file skipped")))
+            elif occurrences:
+                rows.append((href, int(occurrences)))
+            else:
+                not_found += 1
+        if not_found:
+            rows.append((_t("guiMain", "Criteria not found in (files)"), not_found))
+        table = ['<table cellspacing="0" cellpadding="2">']
+        table.append(
+            '<tr><th align="left">{}</th><th align="right">{}</th></tr>'.format(
+                _t("guiMain", "File"), _t("guiMain", "Occurrences")
+            )
+        )
+        for name, value in rows:
+            table.append(
+                '<tr><td>{}</td><td align="right">{}</td></tr>'.format(name, value)
+            )
+        table.append("</table>")
+        return "".join(table)
+
+    def apply_results(self, results, manifest):
+        # Apply the changes to the book only once every file has been merged
+        totals = 0
+        for ident, href, html, occurrences, error in results:
+            if error:
+                manifest.forget(href)
+            if error or not occurrences:
+                continue
+            totals += occurrences
+            # write changed markup back to file
+            self.bk.writefile(ident, html)
+            manifest.record(href, html)
+        manifest.save()
 
         # report totals
         if totals:
@@ -522,16 +789,20 @@ class guiMain(QtWidgets.QMainWindow):
                 "<p>{}".format(_t("guiMain", "Commit all changes and exit"))
             )
             self.abort_button.setDisabled(False)
-            self.text_panel.insertHtml(
+            self.log(
                 "<br><h4>{}:&#160;&#160;&#160;{}</h4>".format(
                     _t("guiMain", "Total occurrences found/changed"), int(totals)
                 )
             )
         else:
-            self.text_panel.insertHtml(
+            self.log(
                 "<br><h4>{}</h4>".format(_t("guiMain", "No changes made to book"))
             )
-        self.text_panel.insertHtml("<br><h4>{}</h4>".format(_t("guiMain", "Finished")))
+
+    def _cancel_clicked(self):
+        if self._worker is not None:
+            self.cancel_button.setDisabled(True)
+            self._worker.cancel()
 
     def _save_config_clicked(self):
         error, criteria = self.validate()
@@ -541,6 +812,8 @@ class guiMain(QtWidgets.QMainWindow):
         headless_prefs = two_up.joinpath(
             "plugins_prefs", self.bk._w.plugin_name, "headless.json"
         )
+        for key in RUN_ONLY_CRITERIA:
+            criteria.pop(key, None)
         with open(headless_prefs, "w", encoding="utf-8") as f:
             json.dump(criteria, f, indent=2, ensure_ascii=False)
 
@@ -572,20 +845,50 @@ class guiMain(QtWidgets.QMainWindow):
             self.update_gui()
 
     def check_for_update(self):
-        """Use updatecheck.py to check for newer versions of the plugin"""
+        """Use UpdateChecker to check for newer versions of the plugin on a
+        worker thread; _update_checked() gets the result."""
         last_time_checked = self.update_prefs["last_time_checked"]
         last_online_version = self.update_prefs["last_online_version"]
-        chk = UpdateChecker(last_time_checked, last_online_version, self.bk._w)
-        update_available, online_version, time = chk.update_info()
+        chk = UpdateChecker(
+            last_time_checked,
+            last_online_version,
+            self.bk._w,
+            self.update_prefs["update_url"],
+        )
+        self._update_thread = QtCore.QThread(self)
+        self._update_worker = UpdateWorker(chk)
+        self._update_worker.moveToThread(self._update_thread)
+        self._update_thread.started.connect(self._update_worker.run)
+        self._update_worker.finished.connect(self._update_checked)
+        self._update_thread.start()
+
+    def _update_checked(self, result):
+        self._update_thread.quit()
+        self._update_thread.wait()
+        self._update_thread = self._update_worker = None
+        if result is None:
+            return
+        update_available, online_version, time = result
         # update preferences with latest date/time/version
         self.update_prefs["last_time_checked"] = time
         if online_version is not None:
             self.update_prefs["last_online_version"] = online_version
         if update_available:
-            return (True, online_version)
-        return (False, online_version)
+            self.label.setText(
+                _t("guiMain", "Plugin Update Available") + " " + str(online_version)
+            )
+            self.label.setVisible(True)
 
     def closeEvent(self, event):
+        if self._thread is not None:
+            # Don't leave the worker running on a destroyed window
+            self._worker.cancel()
+            self._thread.quit()
+            self._thread.wait()
+        if self._update_thread is not None:
+            # Bounded by the update check's network timeouts
+            self._update_thread.quit()
+            self._update_thread.wait()
         if self._ok_to_close:
             event.accept()  # let the window close
         else:
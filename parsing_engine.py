@@ -4,23 +4,307 @@
 
 from __future__ import unicode_literals, division, absolute_import, print_function
 
+import os
+import json
+import time
 from collections import OrderedDict
+from concurrent.futures import ProcessPoolExecutor
+from concurrent.futures.process import BrokenProcessPool
+from html import unescape
 import regex as re
-from sigil_bs4 import BeautifulSoup, Tag
-
-# from bs4 import BeautifulSoup, NavigableString, Tag
+from lxml import etree
+try:
+    from sigil_bs4 import BeautifulSoup, Tag, NavigableString
+except ImportError:
+    # Outside of Sigil (command line tools, benchmarks)
+    from bs4 import BeautifulSoup, Tag, NavigableString
 
 DEBUG = None
 
+# Bump whenever the same input and criteria can give a different result
+# (invalidates the on-disk result caches)
+ENGINE_VERSION = 4
+
+# Merge engines selectable with criteria['engine']
+ENGINES = ("classic", "linear", "postorder")
+# Tree backends selectable with criteria['backend']
+BACKENDS = ("bs4", "lxml", "stream")
+# Ways of producing the merged markup selectable with criteria['output']
+OUTPUTS = ("serialise", "patch")
+# Attribute value comparisons selectable with criteria['srch_method']
+SRCH_METHODS = ("normal", "regex")
+# Keys of a criteria['rules'] entry
+RULE_KEYS = ("tag", "attrib", "srch_str", "srch_method")
+
+XML_NS = "{http://www.w3.org/XML/1998/namespace}"
+_xml_declaration = re.compile(r"""\s*(<\?xml[^>]*\?>)""")
+
+# Markup tokens produced by iter_markup
+TEXT, START, END, EMPTY, OTHER = range(5)
+_any_tag = re.compile(r"""<(?:[^>"']|"[^"]*"|'[^']*')*>""")
+_declaration = re.compile(r"""<!(?:[^>\[]|\[[^\]]*\])*>""")
+_start_tag = re.compile(
+    r"""<([^\s/>!?]+)((?:\s+[^\s=/>]+\s*=\s*(?:"[^"]*"|'[^']*'))*)\s*(/?)>"""
+)
+_end_tag = re.compile(r"""</([^\s>]+)\s*>""")
+_attribute = re.compile(r"""([^\s=/>]+)\s*=\s*(?:"([^"]*)"|'([^']*)')""")
+_markup_ends = (("<!--", "-->"), ("<![CDATA[", "]]>"), ("<?", "?>"))
+
+# Named entity references XML doesn't predefine (&nbsp; and the like). libxml2
+# in recover mode drops them, and with them the predefined references after
+# them, so the tree backends parse them as private-use placeholders and put
+# the references back on output.
+_named_entity = re.compile(r"""&(?!(?:amp|lt|gt|quot|apos);)([A-Za-z_][\w.-]*);""")
+_entity_placeholder = re.compile("\ue000([\\w.-]+)\ue001")
+
+# Prefilter: an element's end (or a self-closing tag) followed, with only text,
+# comments, CDATA or processing instructions in between, by the start of an
+# element with the same local name. Without one no two sibling Tags are equal.
+_candidate_pair = (
+    # End tag, or self-closing tag (attribute values may contain '>')
+    r"""(?:</(?:[^\s/>:]+:)?(%s)\s*>|<(?:[^\s/>:!?]+:)?(%s)(?:\s(?:[^>"']|"[^"]*"|'[^']*')*)?/>)"""
+    # Text, comments, CDATA and processing instructions
+    r"""(?:[^<]++|<!--.*?-->|<!\[CDATA\[.*?\]\]>|<\?.*?\?>)*+"""
+    # Start of an element with the same local name
+    r"""<(?:[^\s/>:!?]+:)?(?:\1|\2)[\s/>]"""
+)
+
+
+def candidate_pattern(tags):
+    """Compiled prefilter pattern for a tag name, or any of a list of them
+    (any tag name when None)."""
+    if tags is None:
+        name = r"""[^\s/>:!?]+"""
+    elif isinstance(tags, str):
+        name = re.escape(tags)
+    else:
+        name = "|".join(re.escape(tag) for tag in tags)
+    return re.compile(_candidate_pair % (name, name), re.S)
+
 
-def attrMatch(attr_str, method, srch_str):
-    if method == "normal":
-        return attr_str == srch_str
-    elif method == "regex":
-        if re.match(r"""%s""" % srch_str, attr_str, re.U) is not None:
-            return True
+class AttrMatcher(object):
+    """Callable testing attribute values against the search criteria.
+    Built once per MarkupParser, so the srch_method branch is taken once and
+    regex criteria are compiled once. Compiled patterns are kept in a bounded
+    LRU shared by all matchers, so a whole book processed with the same regex
+    costs a single compile. cache_info() reports the LRU's hits and misses.
+
+    Regex results are also memoised per attribute value: a book repeats a
+    handful of class values thousands of times, so each distinct value is
+    matched once per run. The memo is dropped when it reaches memo_size
+    values; memo_info() reports its hits and misses."""
+
+    maxsize = 32
+    memo_size = 4096
+    _patterns = OrderedDict()
+    hits = 0
+    misses = 0
+
+    def __init__(self, method, srch_str):
+        self.method = method
+        self.srch_str = srch_str
+        self.results = {}
+        self.memo_hits = 0
+        self.memo_misses = 0
+        if method == "regex":
+            self.pattern = self.compile(srch_str)
+            self.match = self.match_regex
+        elif method == "normal":
+            self.match = self.match_normal
         else:
-            return False
+            self.match = self.match_nothing
+
+    def __call__(self, attr_str):
+        return self.match(attr_str)
+
+    def match_normal(self, attr_str):
+        return attr_str == self.srch_str
+
+    def match_regex(self, attr_str):
+        result = self.results.get(attr_str)
+        if result is not None:
+            self.memo_hits += 1
+            return result
+        self.memo_misses += 1
+        result = self.pattern.match(attr_str) is not None
+        if len(self.results) >= self.memo_size:
+            self.results.clear()
+        self.results[attr_str] = result
+        return result
+
+    def match_nothing(self, attr_str):
+        return False
+
+    @classmethod
+    def compile(cls, srch_str):
+        """Return the compiled pattern for srch_str from the shared LRU."""
+        pattern = cls._patterns.get(srch_str)
+        if pattern is not None:
+            cls.hits += 1
+            cls._patterns.move_to_end(srch_str)
+            return pattern
+        cls.misses += 1
+        pattern = re.compile(srch_str, re.U)
+        cls._patterns[srch_str] = pattern
+        if len(cls._patterns) > cls.maxsize:
+            cls._patterns.popitem(last=False)
+        return pattern
+
+    @classmethod
+    def cache_info(cls):
+        return {
+            "hits": cls.hits,
+            "misses": cls.misses,
+            "size": len(cls._patterns),
+            "maxsize": cls.maxsize,
+        }
+
+    def memo_info(self):
+        return {
+            "hits": self.memo_hits,
+            "misses": self.memo_misses,
+            "size": len(self.results),
+            "maxsize": self.memo_size,
+        }
+
+
+class MergeRule(object):
+    """One tag/attribute criterion of a run: criteria['tag'], ['attrib'],
+    ['srch_str'] and ['srch_method'], or one entry of criteria['rules']."""
+
+    def __init__(self, tag, attrib, srch_str, srch_method):
+        self.tag = tag
+        self.attrib = attrib
+        self.srch_str = srch_str
+        self.srch_method = srch_method
+        self.matcher = None
+        if attrib is not None:
+            self.matcher = AttrMatcher(srch_method, srch_str)
+
+    @classmethod
+    def from_criteria(cls, criteria):
+        return cls(
+            criteria["tag"],
+            criteria["attrib"],
+            criteria["srch_str"],
+            criteria["srch_method"],
+        )
+
+    @classmethod
+    def from_dict(cls, rule):
+        """Rule from a criteria['rules'] entry; missing keys mean any tag,
+        no attribute criterion."""
+        if not isinstance(rule, dict):
+            raise ValueError("Merge rules must be objects, not {!r}".format(rule))
+        unknown = sorted(key for key in rule if key not in RULE_KEYS)
+        if unknown:
+            raise ValueError("Unknown merge rule keys: {}".format(", ".join(unknown)))
+        if rule.get("attrib") is not None and rule.get("srch_str") is None:
+            raise ValueError("Merge rule {!r} has an attrib but no srch_str".format(rule))
+        if rule.get("srch_method", "normal") not in SRCH_METHODS:
+            raise ValueError("Unknown search method: {}".format(rule["srch_method"]))
+        return cls(
+            rule.get("tag"),
+            rule.get("attrib"),
+            rule.get("srch_str"),
+            rule.get("srch_method", "normal"),
+        )
+
+
+def lxml_name(elem):
+    """Return the local tag name of an lxml element the way bs4 names Tags."""
+    tag = elem.tag
+    if tag[0] == "{":
+        return tag.split("}", 1)[1]
+    return tag
+
+
+def lxml_attr_key(elem, attrib):
+    """Translate a (possibly prefixed) attribute name into lxml's {ns}name form."""
+    prefix, sep, local = attrib.partition(":")
+    if not sep:
+        return attrib
+    if prefix == "xml":
+        return XML_NS + local
+    uri = elem.nsmap.get(prefix)
+    if uri is None:
+        return attrib
+    return "{%s}%s" % (uri, local)
+
+
+def iter_markup(chunks):
+    """Split markup arriving as an iterable of text chunks into tokens without
+    building a tree. Yields (kind, text, name, attributes) tuples where kind
+    is TEXT, START, END, EMPTY (self-closing tag) or OTHER (comments, CDATA,
+    processing instructions, declarations). Only the unconsumed tail of the
+    current chunk is ever buffered."""
+    buf = ""
+    chunks = iter(chunks)
+    final = False
+    while not final:
+        chunk = next(chunks, None)
+        if chunk is None:
+            final = True
+        else:
+            buf += chunk
+        pos = 0
+        size = len(buf)
+        while pos < size:
+            if buf[pos] != "<":
+                end = buf.find("<", pos)
+                if end == -1:
+                    if not final:
+                        break
+                    end = size
+                yield TEXT, buf[pos:end], None, None
+                pos = end
+                continue
+            end = -1
+            for opener, closer in _markup_ends:
+                if buf.startswith(opener, pos):
+                    end = buf.find(closer, pos + len(opener))
+                    if end != -1:
+                        end += len(closer)
+                    break
+            else:
+                m = (_declaration if buf.startswith("<!", pos) else _any_tag).match(buf, pos)
+                if m is not None:
+                    end = m.end()
+            if end == -1:
+                if not final:
+                    break
+                # Unterminated markup at the end of the input: pass it through
+                yield TEXT, buf[pos:], None, None
+                pos = size
+                continue
+            text = buf[pos:end]
+            m = _start_tag.fullmatch(text)
+            if m is not None:
+                yield (EMPTY if m.group(3) else START), text, m.group(1), m.group(2)
+            else:
+                m = _end_tag.fullmatch(text)
+                if m is not None:
+                    yield END, text, m.group(1), None
+                else:
+                    yield OTHER, text, None, None
+            pos = end
+        buf = buf[pos:]
+
+
+def parse_attributes(attr_str):
+    """Attribute string of a start tag to a dict of unescaped values."""
+    attrs = {}
+    for m in _attribute.finditer(attr_str):
+        value = m.group(2) if m.group(2) is not None else m.group(3)
+        # XML attribute-value normalisation, as applied by the tree builders
+        value = value.replace("\r\n", " ").replace("\r", " ")
+        value = value.replace("\n", " ").replace("\t", " ")
+        # Entity references XML doesn't define stay references, as the tree
+        # backends see them (as placeholders), so all backends compare alike
+        if "&" in value:
+            value = unescape(_named_entity.sub("\ue000\\1\ue001", value))
+        attrs[m.group(1)] = value
+    return attrs
 
 
 def attrs_equal(a, b):
@@ -34,43 +318,531 @@ def attrs_equal(a, b):
     return all(a[k] == b[k] for k in a)
 
 
+def last_descendant(node):
+    """The last node of a bs4 node's subtree in document order."""
+    while isinstance(node, Tag) and node.contents:
+        node = node.contents[-1]
+    return node
+
+
+def move_contents(source, target):
+    """Move every child of the bs4 Tag source to the end of target's children
+    and drop source. source must follow target among the children of the
+    same parent, with only strings (no Tags) in between. Where Tag.append
+    extracts and inserts the children one at a time, fixing up the parent,
+    sibling and next_element/previous_element links around each, the run
+    of children is relinked as a whole."""
+    parent = source.parent
+    moved = source.contents
+    # What the next_element chain runs through before source: target's
+    # subtree, then the strings between the two
+    target_last = last_descendant(target)
+    between = target_last.next_element
+    before = source.previous_element
+    after = last_descendant(source).next_element
+    if moved:
+        first = moved[0]
+        last = last_descendant(moved[-1])
+        if target.contents:
+            target.contents[-1].next_sibling = first
+            first.previous_sibling = target.contents[-1]
+        else:
+            first.previous_sibling = None
+        for child in moved:
+            child.parent = target
+        target.contents.extend(moved)
+        target_last.next_element = first
+        first.previous_element = target_last
+        if between is source:
+            # Nothing between the two: the moved run ends where source's subtree did
+            last.next_element = after
+            if after is not None:
+                after.previous_element = last
+        else:
+            last.next_element = between
+            between.previous_element = last
+            before.next_element = after
+            if after is not None:
+                after.previous_element = before
+    else:
+        before.next_element = after
+        if after is not None:
+            after.previous_element = before
+    # Unlink source itself
+    del parent.contents[parent.index(source)]
+    if source.previous_sibling is not None:
+        source.previous_sibling.next_sibling = source.next_sibling
+    if source.next_sibling is not None:
+        source.next_sibling.previous_sibling = source.previous_sibling
+    source.contents = []
+    source.parent = source.previous_sibling = source.next_sibling = None
+    source.previous_element = source.next_element = None
+
+
+def join_strings(tag):
+    """Replace each run of adjacent plain strings (not comments, CDATA...)
+    among a bs4 Tag's children with a single string, relinked in place.
+    Returns the number of strings removed."""
+    contents = tag.contents
+    removed = 0
+    i = 0
+    while i < len(contents):
+        if type(contents[i]) is not NavigableString:
+            i += 1
+            continue
+        j = i + 1
+        while j < len(contents) and type(contents[j]) is NavigableString:
+            j += 1
+        if j - i > 1:
+            first = contents[i]
+            last = contents[j - 1]
+            joined = NavigableString("".join(contents[i:j]))
+            joined.parent = tag
+            joined.previous_sibling = first.previous_sibling
+            joined.next_sibling = last.next_sibling
+            joined.previous_element = first.previous_element
+            joined.next_element = last.next_element
+            if joined.previous_sibling is not None:
+                joined.previous_sibling.next_sibling = joined
+            if joined.next_sibling is not None:
+                joined.next_sibling.previous_sibling = joined
+            if joined.previous_element is not None:
+                joined.previous_element.next_element = joined
+            if joined.next_element is not None:
+                joined.next_element.previous_element = joined
+            contents[i:j] = [joined]
+            removed += j - i - 1
+        i += 1
+    return removed
+
+
+def node_label(node):
+    if isinstance(node, Tag):
+        return "<{}>".format(node.name)
+    return repr(str(node)[:20])
+
+
+def check_tree(soup):
+    """Inconsistencies in the links of a parsed bs4 document: every node's
+    parent, sibling and next_element/previous_element links must agree with
+    the contents lists. (The document object itself is not part of the
+    next_element chain.) Returns a list of descriptions, empty for a sound
+    tree."""
+    problems = []
+    order = []
+    stack = [soup]
+    while stack:
+        node = stack.pop()
+        if node is not soup:
+            order.append(node)
+        if not isinstance(node, Tag) or not node.contents:
+            continue
+        previous = None
+        for child in node.contents:
+            if child.parent is not node:
+                problems.append("{} not linked to its parent {}".format(node_label(child), node_label(node)))
+            if child.previous_sibling is not previous:
+                problems.append("{} has the wrong previous_sibling".format(node_label(child)))
+            if previous is not None and previous.next_sibling is not child:
+                problems.append("{} has the wrong next_sibling".format(node_label(previous)))
+            previous = child
+        if previous.next_sibling is not None:
+            problems.append("{} is last but has a next_sibling".format(node_label(previous)))
+        stack.extend(reversed(node.contents))
+    for node, following in zip(order, order[1:]):
+        if node.next_element is not following:
+            problems.append("{} has the wrong next_element".format(node_label(node)))
+        if following.previous_element is not node:
+            problems.append("{} has the wrong previous_element".format(node_label(following)))
+    if order and order[0].previous_element is not None:
+        problems.append("{} is first but has a previous_element".format(node_label(order[0])))
+    if order and order[-1].next_element is not None:
+        problems.append("{} is last but has a next_element".format(node_label(order[-1])))
+    return problems
+
+
+def splice(html, edits):
+    """html with (start, end, replacement) edits applied. replacement is the
+    text replacing html[start:end], or a list of (start, end) ranges of html
+    to insert there. Edits must not overlap; they may come in any order."""
+    edits.sort(key=lambda edit: (edit[0], edit[1]))
+    out = []
+    last = 0
+    for start, end, replacement in edits:
+        out.append(html[last:start])
+        if isinstance(replacement, str):
+            out.append(replacement)
+        else:
+            out.extend(html[s:e] for s, e in replacement)
+        last = end
+    out.append(html[last:])
+    return "".join(out)
+
+
+class Instrument(object):
+    """Per-file timings and work counters of a run, for finding out whether a
+    slow book is spent parsing, matching, merging or serialising. Pass one to
+    MarkupParser to have every process() call recorded in self.files as a
+    dict: the document's key, seconds spent in each of PHASES that ran, and
+    the COUNTERS. totals() aggregates them over the run, summary() gives
+    printable (label, value) pairs and dump() writes everything as JSON."""
+
+    PHASES = ("prefilter", "parse", "merge", "serialise", "stream", "patch")
+    # parents:  elements whose children were swept for adjacent siblings
+    # pairs:    adjacent sibling pairs compared
+    # matches:  criteria attribute values tested (literally or by regex)
+    # memo_hits: of those, regex results found in the matcher's memo
+    # merges:   siblings merged (the occurrences)
+    # joined:   strings removed by joining them to their neighbours (coalesce_text)
+    COUNTERS = ("parents", "pairs", "matches", "memo_hits", "merges", "joined")
+
+    def __init__(self):
+        self.files = []
+        self.record = None
+        self.mark = None
+
+    def begin(self, key=None):
+        """Start the record of a document; returns it for the counters."""
+        self.record = dict.fromkeys(self.COUNTERS, 0)
+        self.record["file"] = key
+        self.record["phases"] = {}
+        self.files.append(self.record)
+        self.mark = time.perf_counter()
+        return self.record
+
+    def lap(self, phase):
+        """Charge the time since the previous lap (or begin) to phase."""
+        now = time.perf_counter()
+        phases = self.record["phases"]
+        phases[phase] = phases.get(phase, 0.0) + now - self.mark
+        self.mark = now
+
+    def add(self, record):
+        """Take over a record made by another Instrument (a worker process)."""
+        self.files.append(record)
+
+    def totals(self):
+        totals = dict.fromkeys(self.COUNTERS, 0)
+        totals["files"] = len(self.files)
+        totals["phases"] = dict.fromkeys(self.PHASES, 0.0)
+        for record in self.files:
+            for counter in self.COUNTERS:
+                totals[counter] += record[counter]
+            for phase, seconds in record["phases"].items():
+                totals["phases"][phase] += seconds
+        return totals
+
+    def summary(self, slowest=5):
+        totals = self.totals()
+        lines = [("Files instrumented", totals["files"])]
+        for phase in self.PHASES:
+            if totals["phases"][phase]:
+                lines.append(("Time in " + phase, "{:.3f} s".format(totals["phases"][phase])))
+        lines.extend([
+            ("Parents visited", totals["parents"]),
+            ("Sibling pairs compared", totals["pairs"]),
+            ("Attribute values tested", totals["matches"]),
+            ("Regex results reused", totals["memo_hits"]),
+            ("Merges", totals["merges"]),
+            ("Text nodes joined", totals["joined"]),
+        ])
+        ranked = sorted(self.files, key=lambda r: sum(r["phases"].values()), reverse=True)
+        for record in ranked[:slowest]:
+            key = record["file"]
+            if isinstance(key, tuple):
+                # (ident, href) pairs: the href is what users know
+                key = key[-1]
+            lines.append(("Slow file {}".format(key), "{:.3f} s".format(sum(record["phases"].values()))))
+        return lines
+
+    def dump(self, path):
+        with open(path, "w", encoding="utf-8") as f:
+            json.dump(
+                {"totals": self.totals(), "files": self.files},
+                f, indent=1, ensure_ascii=False, default=str,
+            )
+
+
+class ParentQueue(object):
+    """Distinct parents to sweep, handed out one nesting level at a time:
+    shallowest first (ancestors before descendants, like a pre-order walk)
+    or deepest first (descendants before ancestors, like a post-order walk).
+    Merging only moves children between siblings, so it never changes the
+    depth of a queued parent; push() may queue more parents while they are
+    being handed out, e.g. a tag that received merged children. depth is the
+    level being handed out."""
+
+    def __init__(self, depth_of, deepest_first=False):
+        self.depth_of = depth_of
+        self.deepest_first = deepest_first
+        self.levels = {}
+        # By id(): bs4 Tags hash (and compare) by their markup
+        self.queued = set()
+        self.depth = None
+
+    def push(self, parent, depth=None):
+        if id(parent) in self.queued:
+            return
+        self.queued.add(id(parent))
+        if depth is None:
+            depth = self.depth_of(parent)
+        self.levels.setdefault(depth, []).append(parent)
+
+    def __iter__(self):
+        while self.levels:
+            self.depth = max(self.levels) if self.deepest_first else min(self.levels)
+            for parent in self.levels.pop(self.depth):
+                yield parent
+
+
 class MarkupParser(object):
-    """The criteria parameter dictionary specs
-    criteria['html']              Param 1 - the contents of the (x)html file: unicode text.
+    """Configure once with the criteria, then call process(html) for each
+    document of a run so compiled matchers, signatures and parsers are
+    shared by every file.
+
+    The criteria parameter dictionary specs
+    criteria['html']              Param 1 - the contents of the (x)html file: unicode text (optional, for processml())
     criteria['action']            Param 2 - action to take: unicode text ('modify' or 'delete')
     criteria['tag']               Param 3 - tag to alter/delete: unicode text
     criteria['attrib']            Param 4 - attribute to use in match: unicode text or None
     criteria['srch_str']          Param 5 - value of the attribute to use in match: unicode text (literal or regexp) or None
     criteria['srch_method']       Param 6 - is the value given literal or a regexp: boolean
+    criteria['engine']            Param 7 - merge engine to use: unicode text (one of ENGINES, optional)
+                                            'classic' rebuilds the sibling list after every merge,
+                                            'linear' coalesces each run of equal siblings in a single sweep
+                                            'postorder' sweeps children before parents in one walk of the tree
+    criteria['backend']           Param 8 - tree backend to use: unicode text (one of BACKENDS, optional)
+                                            'bs4' parses with sigil_bs4 and honours criteria['engine'],
+                                            'lxml' parses with lxml.etree and always merges in post-order
+                                            'stream' merges the token stream of iter_markup without a tree
+    criteria['class_as_set']      Param 9 - compare class attributes as unordered sets of names: boolean (optional)
+    criteria['prefilter']         Param 10 - return documents with no candidate adjacency unparsed: boolean (optional,
+                                            default True); short_circuited counts them
+    criteria['rules']             Param 11 - list of {'tag', 'attrib', 'srch_str', 'srch_method'} objects (optional):
+                                            merge rules applied in order within one parse of each document,
+                                            instead of Params 3 to 6. Other keys, an unknown srch_method or
+                                            an attrib without a srch_str raise ValueError
+    criteria['dry_run']           Param 12 - only count the merges: boolean (optional); processml() returns None for
+                                            the markup. Merges are counted on the token stream, whatever the
+                                            backend and engine: every merge drops one element and they all
+                                            merge to the same document, so the counts are those of a real run,
+                                            without building or changing a tree
+    criteria['output']            Param 13 - how the merged markup is produced: unicode text (one of OUTPUTS, optional)
+                                            'serialise' writes out the backend's merged tree or token stream,
+                                            'patch' splices the merges into the source (see patch_markup),
+                                            leaving all other markup byte for byte as it was, whatever
+                                            criteria['backend'] is
+    criteria['coalesce_text']     Param 14 - join the adjacent strings left by merging into one: boolean
+                                            (optional; bs4 backend only, lxml keeps text in one piece anyway).
+                                            The markup is the same, the tree smaller and faster to serialise
+
+    instrument (optional) is an Instrument recording each process() call.
     """
 
-    def __init__(self, criteria):
-        self.wipml = criteria["html"]
+    def __init__(self, criteria, instrument=None):
+        self.wipml = criteria.get("html")
+        # Everything but the document, for handing to worker processes
+        self.criteria = {k: v for k, v in criteria.items() if k != "html"}
         self.action = criteria["action"]
-        self.tag = criteria["tag"]
-        self.attrib = criteria["attrib"]
-        self.srch_str = criteria["srch_str"]
-        self.srch_method = criteria["srch_method"]
+        if "rules" in criteria:
+            self.rules = [MergeRule.from_dict(rule) for rule in criteria["rules"]]
+            if not self.rules:
+                raise ValueError("No merge rules given")
+        else:
+            self.rules = [MergeRule.from_criteria(criteria)]
+        self.engine = criteria.get("engine", "classic")
+        if self.engine not in ENGINES:
+            raise ValueError("Unknown merge engine: {}".format(self.engine))
+        self.backend = criteria.get("backend", "bs4")
+        if self.backend not in BACKENDS:
+            raise ValueError("Unknown tree backend: {}".format(self.backend))
+        self.class_as_set = criteria.get("class_as_set", False)
+        self.prefilter = criteria.get("prefilter", True)
+        self.dry_run = criteria.get("dry_run", False)
+        self.output = criteria.get("output", "serialise")
+        self.coalesce_text = criteria.get("coalesce_text", False)
+        if self.output not in OUTPUTS:
+            raise ValueError("Unknown output mode: {}".format(self.output))
+        # The prefilter looks for a candidate of any of the rules
+        tags = None
+        if all(rule.tag is not None for rule in self.rules):
+            tags = sorted(set(rule.tag for rule in self.rules))
+        self.candidates = candidate_pattern(tags)
+        self.attrib_present = None
+        if all(rule.attrib is not None for rule in self.rules):
+            attribs = sorted(set(rule.attrib for rule in self.rules))
+            self.attrib_present = re.compile(
+                r"""\s(?:%s)\s*=""" % "|".join(re.escape(a) for a in attribs)
+            )
+        self.short_circuited = 0
+        # Interned attribute signatures, and signatures of stream start tags by raw attribute string
+        self.signatures = {}
+        self.raw_signatures = {}
+        self.lxml_parser = etree.XMLParser(
+            encoding="utf-8",
+            recover=True,
+            strip_cdata=False,
+            resolve_entities=False,
+            huge_tree=True,
+        )
+        self.occurrences = 0
+        self.instrument = instrument
+        # Counters of the document being instrumented (None when not instrumenting)
+        self.stats = None
+        # Tags that received merged children and their parents (which lost
+        # the merged siblings), by id(), while coalescing text
+        self.merged = None
+        # Whether the parsed document's entity references are placeholders
+        self.placeholders = False
+
+    def process(self, html, key=None):
+        """Merge one document. Returns the new markup and the number of
+        occurrences changed in that document. key labels the document in
+        the instrumentation."""
+        self.wipml = html
         self.occurrences = 0
+        if self.instrument is None:
+            return self.processml()
+        self.stats = self.instrument.begin(key)
+        memo_hits = self.memo_hits()
+        try:
+            return self.processml()
+        finally:
+            self.stats["memo_hits"] = self.memo_hits() - memo_hits
+            self.stats["merges"] = self.occurrences
+            self.stats = None
+
+    def memo_hits(self):
+        """Attribute values of this run whose regex match was memoised."""
+        return sum(rule.matcher.memo_hits for rule in self.rules if rule.matcher is not None)
+
+    def has_candidates(self, html):
+        """Cheap scan of the raw markup: can it contain anything to merge?"""
+        if self.attrib_present is not None and self.attrib_present.search(html) is None:
+            return False
+        return self.candidates.search(html) is not None
 
     def processml(self):
-        if self.action == "merge":
-            soup = BeautifulSoup(self.wipml, "xml")
-            # Perform merging
-            newsoup = self.merge_adjacent_tags(soup)
-            # print(f'html: {newsoup.serialize_xhtml}\noccurrences: {self.occurrences}')
-            return str(newsoup), self.occurrences
-        else:
+        if self.action != "merge":
             return None, self.occurrences
+        lap = None
+        if self.stats is not None:
+            lap = self.instrument.lap
+        if self.prefilter:
+            candidates = self.has_candidates(self.wipml)
+            if lap is not None:
+                lap("prefilter")
+            if not candidates:
+                self.short_circuited += 1
+                if self.dry_run:
+                    return None, self.occurrences
+                return self.wipml, self.occurrences
+        if self.dry_run:
+            for chunk in self.merge_stream([self.wipml]):
+                pass
+            if lap is not None:
+                lap("stream")
+            return None, self.occurrences
+        if self.output == "patch":
+            html = self.wipml
+            for rule in self.rules:
+                html = self.patch_markup(html, rule)
+            if lap is not None:
+                lap("patch")
+            return html, self.occurrences
+        if self.backend == "stream":
+            html = "".join(self.merge_stream([self.wipml]))
+            if lap is not None:
+                lap("stream")
+            return html, self.occurrences
+        tree = self.parse()
+        if lap is not None:
+            lap("parse")
+        # Perform merging
+        tree = self.merge(tree)
+        if lap is not None:
+            lap("merge")
+        html = self.serialise(tree)
+        if lap is not None:
+            lap("serialise")
+        return html, self.occurrences
+
+    def parse(self):
+        """Build the backend's tree (soup or lxml root) of the current document."""
+        html = self.wipml
+        self.placeholders = "\ue000" not in html and _named_entity.search(html) is not None
+        if self.placeholders:
+            html = _named_entity.sub("\ue000\\1\ue001", html)
+        if self.backend == "lxml":
+            return etree.fromstring(html.encode("utf-8"), self.lxml_parser)
+        return BeautifulSoup(html, "xml")
+
+    def merge(self, tree):
+        """Apply every rule to the tree in turn."""
+        if self.coalesce_text and self.backend == "bs4":
+            self.merged = {}
+        for rule in self.rules:
+            if self.backend == "lxml":
+                tree = self.merge_adjacent_elements(tree, rule)
+            elif self.engine == "linear":
+                tree = self.merge_adjacent_tags_linear(tree, rule)
+            elif self.engine == "postorder":
+                tree = self.merge_adjacent_tags_postorder(tree, rule)
+            else:
+                tree = self.merge_adjacent_tags(tree, rule)
+        if self.merged is not None:
+            joined = 0
+            for tag in self.merged.values():
+                joined += join_strings(tag)
+            self.merged = None
+            if self.stats is not None:
+                self.stats["joined"] += joined
+        if DEBUG is not None and self.backend != "lxml":
+            for problem in check_tree(tree):
+                print(f"broken tree: {problem}")
+        return tree
+
+    def serialise(self, tree):
+        """Markup of a merged tree. lxml keeps the source's attribute order and
+        whitespace rather than bs4's, and the document's XML declaration."""
+        if self.backend == "lxml":
+            html = etree.tostring(tree.getroottree(), encoding="unicode")
+            m = _xml_declaration.match(self.wipml)
+            if m is not None:
+                html = m.group(1) + "\n" + html
+        else:
+            # print(f'html: {tree.serialize_xhtml}\noccurrences: {self.occurrences}')
+            html = str(tree)
+        if self.placeholders:
+            html = _entity_placeholder.sub(r"&\1;", html)
+        return html
+
+    def candidate_parents(self, soup, rule, deepest_first=False):
+        """ParentQueue of the parents of the tags named by the rule: no other
+        parent has children that can merge. None if the rule takes any tag."""
+        if rule.tag is None:
+            return None
+        parents = ParentQueue(lambda tag: sum(1 for _ in tag.parents), deepest_first)
+        for tag in soup.find_all(rule.tag):
+            # Top-level siblings are never merged
+            if tag.parent is not soup:
+                parents.push(tag.parent)
+        return parents
 
-    def merge_adjacent_tags(self, soup):
+    def merge_adjacent_tags(self, soup, rule):
         """Recursively merge adjacent tags with same name and attributes."""
-        # Find all elements that can have siblings (avoid text-only roots)
-        for parent in soup.find_all():
+        parents = self.candidate_parents(soup, rule)
+        if parents is None:
+            # Find all elements that can have siblings (avoid text-only roots)
+            parents = soup.find_all()
+        for parent in parents:
             children = [
                 child for child in list(parent.children) if isinstance(child, Tag)
             ]
             i = 0
+            if self.stats is not None:
+                self.stats["parents"] += 1
+                self.stats["pairs"] += max(len(children) - 1, 0)
             if DEBUG is not None:
                 print(f"parent has {len(children)} children")
             while i < len(children) - 1:
@@ -89,28 +861,28 @@ class MarkupParser(object):
                     current.name == next_node.name
                     and current.name is not None
                     and (
-                        self.attrib is None
+                        rule.attrib is None
                         or (
-                            self.attrib in current.attrs.keys()
-                            and attrMatch(
-                                current.attrs[self.attrib],
-                                self.srch_method,
-                                self.srch_str,
-                            )
+                            rule.attrib in current.attrs.keys()
+                            and self.classic_match(rule, current.attrs[rule.attrib])
                         )
                     )
-                    and (self.tag is None or current.name == self.tag)
-                    and attrs_equal(current.attrs, next_node.attrs)
+                    and (rule.tag is None or current.name == rule.tag)
+                    and self.classic_attrs_equal(current, next_node)
                 ):
                     # Move all contents of next_node into current
                     if DEBUG is not None:
                         print(
                             f"current_node: {str(current)}\nnext_node: {str(next_node)}"
                         )
-                    for child in list(next_node.contents):
-                        current.append(child)
-                    next_node.decompose()  # Remove the merged node
+                    move_contents(next_node, current)  # and remove the merged node
+                    if self.merged is not None:
+                        self.merged[id(current)] = current
+                        self.merged[id(parent)] = parent
                     self.occurrences += 1
+                    if isinstance(parents, ParentQueue):
+                        # Its new children may merge too
+                        parents.push(current, parents.depth + 1)
                     # Rebuild children list after modification
                     children = [
                         child
@@ -124,3 +896,579 @@ class MarkupParser(object):
 
         # Recursion is implicit via full tree traversal above
         return soup
+
+    def classic_attrs_equal(self, current, next_node):
+        """Attribute comparison of the classic engine: exact, unless class
+        attributes compare as sets (then by signature, as the other engines do)."""
+        if self.class_as_set:
+            return self.signature(current.name, current.attrs) is self.signature(next_node.name, next_node.attrs)
+        return attrs_equal(current.attrs, next_node.attrs)
+
+    def classic_match(self, rule, value):
+        if self.stats is not None:
+            self.stats["matches"] += 1
+        return rule.matcher(value)
+
+    def signature(self, name, attrs):
+        """Return the interned, hashable signature of a tag name and its
+        attributes. Tags with equal names and attributes get the identical
+        signature object, so adjacent siblings compare with a single 'is'."""
+        items = []
+        for key, value in attrs.items():
+            if isinstance(value, list):
+                value = " ".join(value)
+            if self.class_as_set and key == "class":
+                value = frozenset(value.split())
+            items.append((key, value))
+        # Keys are unique, so sorting never compares the values
+        items.sort()
+        sig = (name, tuple(items))
+        return self.signatures.setdefault(sig, sig)
+
+    def accepts(self, rule, name, value):
+        """Do a tag's name and rule attribute value (None if missing) allow
+        following equal siblings to be merged into it?"""
+        if rule.tag is not None and name != rule.tag:
+            return False
+        if rule.attrib is not None:
+            if value is None:
+                return False
+            if self.stats is not None:
+                self.stats["matches"] += 1
+            return rule.matcher(value)
+        return True
+
+    def merge_adjacent_tags_linear(self, soup, rule):
+        """Merge adjacent tags with same name and attributes, walking each
+        parent's children once. A run of equal siblings is coalesced into its
+        first member in a single sweep instead of rebuilding the sibling list
+        after every merge, so occurrences are counted exactly as in
+        merge_adjacent_tags. Only the parents of the rule's tags are swept
+        when it names one."""
+        parents = self.candidate_parents(soup, rule)
+        if parents is None:
+            for parent in soup.find_all():
+                self.sweep_children(parent, rule)
+            return soup
+        for parent in parents:
+            for current in self.sweep_children(parent, rule):
+                parents.push(current, parents.depth + 1)
+        return soup
+
+    def merge_adjacent_tags_postorder(self, soup, rule):
+        """Merge adjacent tags with same name and attributes in a single
+        post-order walk: every parent is swept after all of its descendants.
+        Whenever a merge makes new grandchildren adjacent, the receiving tag is
+        swept again, so the result is a fixed point and running the plugin a
+        second time finds nothing more to merge. No list of all elements is
+        ever built; the walk only keeps one child iterator per nesting level.
+        When the rule names a tag only its parents are swept, deepest first."""
+        parents = self.candidate_parents(soup, rule, deepest_first=True)
+        if parents is not None:
+            for parent in parents:
+                pending = [parent]
+                while pending:
+                    pending.extend(self.sweep_children(pending.pop(), rule))
+            return soup
+        stack = [(soup, iter(soup.contents))]
+        while stack:
+            node, children = stack[-1]
+            # contents of node do not change until node itself is swept
+            for child in children:
+                if isinstance(child, Tag):
+                    stack.append((child, iter(child.contents)))
+                    break
+            else:
+                stack.pop()
+                # Top-level siblings are never merged, as with find_all()
+                if node is soup:
+                    continue
+                pending = [node]
+                while pending:
+                    pending.extend(self.sweep_children(pending.pop(), rule))
+        return soup
+
+    def sweep_children(self, parent, rule):
+        """Coalesce each run of mergeable Tag children of parent into its
+        first member. Returns the tags that received merged contents."""
+        merged_into = []
+        current = current_sig = accepted = None
+        tags = 0
+        # Snapshot: merged siblings are removed from parent while walking
+        for child in list(parent.children):
+            if not isinstance(child, Tag):
+                continue
+            tags += 1
+            sig = self.signature(child.name, child.attrs)
+            if sig is current_sig:
+                if accepted is None:
+                    accepted = self.accepts(rule, current.name, current.get(rule.attrib))
+                if accepted:
+                    move_contents(child, current)
+                    self.occurrences += 1
+                    if not merged_into or merged_into[-1] is not current:
+                        merged_into.append(current)
+                        if self.merged is not None:
+                            self.merged[id(current)] = current
+                            self.merged[id(parent)] = parent
+                    continue
+            current, current_sig, accepted = child, sig, None
+        if self.stats is not None:
+            self.stats["parents"] += 1
+            self.stats["pairs"] += max(tags - 1, 0)
+        return merged_into
+
+    def merge_adjacent_elements(self, root, rule):
+        """lxml counterpart of merge_adjacent_tags_postorder, with the merge
+        semantics of merge_adjacent_tags."""
+        if rule.tag is not None:
+            parents = ParentQueue(lambda elem: sum(1 for _ in elem.iterancestors()), deepest_first=True)
+            # Elements of that local name in any (or no) namespace
+            for elem in root.iter("{*}" + rule.tag.rpartition(":")[2]):
+                if elem.getparent() is not None:
+                    parents.push(elem.getparent())
+            for parent in parents:
+                pending = [parent]
+                while pending:
+                    pending.extend(self.sweep_elements(pending.pop(), rule))
+            return root
+        stack = [(root, iter(root))]
+        while stack:
+            node, children = stack[-1]
+            for child in children:
+                if isinstance(child.tag, str):
+                    stack.append((child, iter(child)))
+                    break
+            else:
+                stack.pop()
+                pending = [node]
+                while pending:
+                    pending.extend(self.sweep_elements(pending.pop(), rule))
+        return root
+
+    def sweep_elements(self, parent, rule):
+        """lxml counterpart of sweep_children."""
+        merged_into = []
+        current = current_sig = accepted = None
+        tags = 0
+        for child in list(parent):
+            # Skip comments, processing instructions and entities
+            if not isinstance(child.tag, str):
+                continue
+            tags += 1
+            sig = self.signature(lxml_name(child), child.attrib)
+            if sig is current_sig:
+                if accepted is None:
+                    value = None
+                    if rule.attrib is not None:
+                        value = current.get(lxml_attr_key(current, rule.attrib))
+                    accepted = self.accepts(rule, sig[0], value)
+                if not accepted:
+                    current, accepted = child, None
+                    continue
+                # Leading text of child follows current's last descendant
+                if child.text:
+                    if len(current):
+                        last = current[-1]
+                        last.tail = (last.tail or "") + child.text
+                    else:
+                        current.text = (current.text or "") + child.text
+                current.extend(list(child))
+                # Whatever followed child stays where child used to be
+                previous = child.getprevious()
+                if child.tail:
+                    previous.tail = (previous.tail or "") + child.tail
+                parent.remove(child)
+                self.occurrences += 1
+                if not merged_into or merged_into[-1] is not current:
+                    merged_into.append(current)
+            else:
+                current, current_sig, accepted = child, sig, None
+        if self.stats is not None:
+            self.stats["parents"] += 1
+            self.stats["pairs"] += max(tags - 1, 0)
+        return merged_into
+
+    def merge_stream(self, chunks):
+        """Apply every rule to markup read from an iterable of text chunks:
+        one processml_stream per rule, each consuming the previous one's
+        output as it is produced."""
+        for rule in self.rules:
+            chunks = self.processml_stream(chunks, rule)
+        return chunks
+
+    def processml_stream(self, chunks, rule):
+        """Merge markup read from an iterable of text chunks, yielding the
+        merged markup incrementally. No tree is built: every nesting level
+        only keeps the last closed sibling (its end tag and whatever text or
+        comments follow it) until the next sibling shows whether the two merge,
+        so memory is bounded by nesting depth rather than by file size.
+        Markup is passed through as written in the source."""
+        out = []
+        # Open element frames: [name, raw name, attribute string, signature,
+        #                       pending record of its children, record to resume]
+        # Records of closed elements: [frame, head, end tag, held text]
+        stack = [[None, None, None, None, None, None]]
+        for kind, text, name, attr_str in iter_markup(chunks):
+            frame = stack[-1]
+            record = frame[4]
+            if kind == TEXT or kind == OTHER:
+                if record is not None:
+                    record[3].append(text)
+                else:
+                    out.append(text)
+            elif kind == END:
+                if len(stack) == 1:
+                    # Stray end tag at document level
+                    if record is not None:
+                        record[3].append(text)
+                    else:
+                        out.append(text)
+                    continue
+                stack.pop()
+                resume = frame[5]
+                if resume is not None:
+                    # End of a merged sibling: the original end tag is still held
+                    resume[0][4] = record
+                    stack[-1][4] = resume
+                else:
+                    stack[-1][4] = [frame, None, text, []]
+            else:
+                new = [name.rpartition(":")[2], name, attr_str, None, None, None]
+                # Like the tree engines, top-level siblings are never merged
+                if (
+                    record is not None
+                    and len(stack) > 1
+                    and self.mergeable_stream(record[0], new, rule)
+                ):
+                    self.occurrences += 1
+                    if kind == EMPTY:
+                        continue
+                    frame[4] = None
+                    if record[1] is not None:
+                        # Merging into a self-closing tag: open it up
+                        out.append(record[1][:-2].rstrip() + ">")
+                        record[1] = None
+                        record[2] = "</{}>".format(record[0][1])
+                    anchor = record[0]
+                    new[3] = anchor[3]
+                    new[4] = anchor[4]
+                    new[5] = record
+                    stack.append(new)
+                    continue
+                if record is not None:
+                    self.flush_record(record, out)
+                    frame[4] = None
+                if kind == EMPTY:
+                    frame[4] = [new, text, None, []]
+                else:
+                    out.append(text)
+                    stack.append(new)
+                    if self.stats is not None:
+                        self.stats["parents"] += 1
+            if len(out) > 255:
+                yield "".join(out)
+                out = []
+        # Close anything left open by truncated input
+        while len(stack) > 1:
+            frame = stack.pop()
+            if frame[4] is not None:
+                self.flush_record(frame[4], out)
+            if frame[5] is not None:
+                frame[5][0][4] = None
+                self.flush_record(frame[5], out)
+        if stack[0][4] is not None:
+            self.flush_record(stack[0][4], out)
+        if out:
+            yield "".join(out)
+
+    def flush_record(self, record, out):
+        """Emit a closed element's pending markup (its self-closing tag or its
+        children's pending markup and end tag, then the text held after it)."""
+        if record[1] is not None:
+            out.append(record[1])
+        elif record[0][4] is not None:
+            self.flush_record(record[0][4], out)
+        if record[2] is not None:
+            out.append(record[2])
+        out.extend(record[3])
+
+    def patch_markup(self, html, rule):
+        """Merge html by splicing it rather than rewriting it. The merges are
+        found as in processml_stream, but only their source ranges are
+        recorded: the end tag of each merged element and the start tag of the
+        sibling merged into it are cut, and the text held between the two is
+        moved after the sibling's end tag, which is given the merged element's
+        own end tag if it differs (m:span and span merge). Everything else is
+        copied from html byte for byte, so the cost of building the result
+        grows with the number of edits rather than of tokens."""
+        edits = []
+        # Element frames as in processml_stream. Records of closed elements:
+        # [frame, self-closing tag range, end tag range, start of the held
+        #  text, held text ranges before merged self-closing tags, text
+        #  ranges moved after the end tag, end tag of the first element merged
+        #  (None while nothing merged into it)]. Text and comments are held
+        #  simply by being left where they are.
+        stack = [[None, None, None, None, None, None]]
+        pos = 0
+        for kind, text, name, attr_str in iter_markup((html,)):
+            start = pos
+            pos += len(text)
+            if kind == TEXT or kind == OTHER:
+                continue
+            frame = stack[-1]
+            record = frame[4]
+            if kind == END:
+                if len(stack) == 1:
+                    # Stray end tag at document level
+                    continue
+                stack.pop()
+                resume = frame[5]
+                if resume is not None:
+                    # End of a merged sibling: its end tag now ends the merged element
+                    resume[0][4] = record
+                    resume[2] = (start, pos)
+                    resume[3] = pos
+                    stack[-1][4] = resume
+                else:
+                    stack[-1][4] = [frame, None, (start, pos), pos, [], [], None]
+            else:
+                new = [name.rpartition(":")[2], name, attr_str, None, None, None]
+                if (
+                    record is not None
+                    and len(stack) > 1
+                    and self.mergeable_stream(record[0], new, rule)
+                ):
+                    self.occurrences += 1
+                    edits.append((start, pos, ""))
+                    if record[3] < start:
+                        record[4].append((record[3], start))
+                    record[3] = pos
+                    if kind == EMPTY:
+                        continue
+                    frame[4] = None
+                    if record[1] is not None:
+                        # Merging into a self-closing tag: open it up
+                        head_start, head_end = record[1]
+                        edits.append((head_start, head_end, html[head_start:head_end - 2].rstrip() + ">"))
+                        record[1] = None
+                        record[2] = (head_end, head_end)
+                        record[6] = "</{}>".format(record[0][1])
+                    else:
+                        edits.append((record[2][0], record[2][1], ""))
+                        if record[6] is None:
+                            record[6] = html[record[2][0]:record[2][1]]
+                    # The held text moves after the merged element
+                    for text_start, text_end in record[4]:
+                        edits.append((text_start, text_end, ""))
+                    record[5].extend(record[4])
+                    record[4] = []
+                    anchor = record[0]
+                    child = anchor[4]
+                    if child is not None:
+                        # The last child's held text resumes inside the sibling
+                        if child[3] < record[2][0]:
+                            child[4].append((child[3], record[2][0]))
+                        child[3] = pos
+                    # Until the sibling ends the element has no end tag in place
+                    record[2] = (record[2][1], record[2][1])
+                    new[3] = anchor[3]
+                    new[4] = anchor[4]
+                    new[5] = record
+                    stack.append(new)
+                    continue
+                if record is not None:
+                    self.flush_patches(html, record, edits)
+                    frame[4] = None
+                if kind == EMPTY:
+                    frame[4] = [new, (start, pos), None, pos, [], [], None]
+                else:
+                    stack.append(new)
+                    if self.stats is not None:
+                        self.stats["parents"] += 1
+        # Close anything left open by truncated input
+        while len(stack) > 1:
+            frame = stack.pop()
+            if frame[4] is not None:
+                self.flush_patches(html, frame[4], edits)
+            if frame[5] is not None:
+                frame[5][0][4] = None
+                self.flush_patches(html, frame[5], edits)
+        if stack[0][4] is not None:
+            self.flush_patches(html, stack[0][4], edits)
+        return splice(html, edits)
+
+    def flush_patches(self, html, record, edits):
+        """Give a closed element that merges no further its first end tag,
+        insert the text moved after it (and do the same for its children's
+        pending records)."""
+        if record[6] is not None and record[2] is not None:
+            end_start, end_end = record[2]
+            if html[end_start:end_end] != record[6]:
+                edits.append((end_start, end_end, record[6]))
+        if record[5]:
+            at = (record[2] or record[1])[1]
+            edits.append((at, at, record[5]))
+        if record[1] is None and record[0][4] is not None:
+            self.flush_patches(html, record[0][4], edits)
+
+    def mergeable_stream(self, current, next_node, rule):
+        """Token-stream counterpart of the sweeps' merge test, for element frames."""
+        if self.stats is not None:
+            self.stats["pairs"] += 1
+        if current[0] != next_node[0]:
+            return False
+        if self.stream_signature(current) is not self.stream_signature(next_node):
+            return False
+        value = None
+        if rule.attrib is not None:
+            value = parse_attributes(current[2]).get(rule.attrib)
+        return self.accepts(rule, current[0], value)
+
+    def stream_signature(self, frame):
+        """Signature of an element frame, looked up by its raw attribute string
+        so that each distinct start tag is parsed only once."""
+        if frame[3] is None:
+            key = (frame[0], frame[2])
+            sig = self.raw_signatures.get(key)
+            if sig is None:
+                sig = self.signature(frame[0], parse_attributes(frame[2]))
+                self.raw_signatures[key] = sig
+            frame[3] = sig
+        return frame[3]
+
+
+# MarkupParser of a process_documents worker process
+_worker_parser = None
+
+
+def _init_worker(criteria, instrumented):
+    global _worker_parser
+    _worker_parser = MarkupParser(criteria, Instrument() if instrumented else None)
+
+
+def _process_document(parser, html, key=None):
+    try:
+        html, occurrences = parser.process(html, key)
+    except Exception as e:
+        return None, 0, e
+    return html, occurrences, None
+
+
+def _process_in_worker(document):
+    key, html = document
+    short_circuited = _worker_parser.short_circuited
+    html, occurrences, error = _process_document(_worker_parser, html, key)
+    if error is not None:
+        # Keep the result picklable whatever the exception was
+        error = repr(error)
+    record = None
+    if _worker_parser.instrument is not None:
+        record = _worker_parser.instrument.files.pop()
+    return html, occurrences, error, _worker_parser.short_circuited - short_circuited, record
+
+
+def _cached_process(parser, cache, key, html):
+    if cache is not None:
+        hit = cache.get(html)
+        if hit is not None:
+            return hit + (None,)
+    result = _process_document(parser, html, key)
+    if cache is not None and result[2] is None:
+        cache.put(html, result[0], result[1])
+    return result
+
+
+def worker_pool(parser, jobs):
+    """ProcessPoolExecutor of jobs worker processes (0 or None: one per CPU),
+    each with its own MarkupParser of parser's criteria, for
+    process_documents(pool=...); None when that comes to a single process.
+    The caller shuts it down."""
+    cpus = os.cpu_count() or 1
+    if not jobs:
+        jobs = cpus
+    jobs = min(jobs, cpus)
+    if jobs < 2:
+        return None
+    try:
+        return ProcessPoolExecutor(
+            jobs,
+            initializer=_init_worker,
+            initargs=(parser.criteria, parser.instrument is not None),
+        )
+    except OSError as e:
+        print("Parallel processing unavailable ({}); continuing serially.".format(e))
+        return None
+
+
+def process_documents(parser, documents, jobs=1, cache=None, pool=None):
+    """Merge an iterable of (key, html) pairs with parser's criteria, yielding
+    (key, html, occurrences, error) in input order; error is None unless the
+    document could not be processed. Results found in cache (a ResultCache,
+    optional) are used as is, and new ones are stored there. With jobs > 1
+    (0 or None: one per CPU) the documents are read up front and the cache
+    misses are merged by a pool of worker processes, each with its own
+    MarkupParser (their prefilter short-circuits are added to
+    parser.short_circuited and their instrumentation to parser.instrument;
+    keys must then be picklable). A pool from worker_pool() can be given
+    instead, to share one between calls: the cache misses are then handed to
+    it before this returns, so the documents of several calls can be in the
+    works at once. On a single CPU, or if the pool cannot be used, documents
+    are merged one at a time by parser in this process."""
+    if pool is not None:
+        return _collect_documents(parser, _submit_documents(parser, documents, pool, cache), cache)
+    return _process_documents(parser, documents, jobs, cache)
+
+
+def _process_documents(parser, documents, jobs, cache):
+    pool = worker_pool(parser, jobs)
+    if pool is None:
+        for key, html in documents:
+            yield (key,) + _cached_process(parser, cache, key, html)
+        return
+    with pool:
+        for result in _collect_documents(parser, _submit_documents(parser, documents, pool, cache), cache):
+            yield result
+
+
+def _submit_documents(parser, documents, pool, cache):
+    """[key, html, cached result or Future of _process_in_worker] of each
+    document (the Future None if the pool can't take it)."""
+    pending = []
+    for key, html in documents:
+        result = None
+        if cache is not None:
+            result = cache.get(html)
+        if result is None and pool is not None:
+            try:
+                result = pool.submit(_process_in_worker, (key, html))
+            except (BrokenProcessPool, OSError, RuntimeError) as e:
+                print("Parallel processing unavailable ({}); continuing serially.".format(e))
+                pool = None
+        pending.append([key, html, result])
+    return pending
+
+
+def _collect_documents(parser, pending, cache):
+    serial = False
+    for key, html, result in pending:
+        if isinstance(result, tuple):
+            # From the cache
+            yield (key,) + result + (None,)
+            continue
+        if result is not None and not serial:
+            try:
+                result = result.result()
+            except (BrokenProcessPool, OSError) as e:
+                print("Parallel processing unavailable ({}); continuing serially.".format(e))
+                serial = True
+        if result is None or serial:
+            result = _process_document(parser, html, key)
+        else:
+            parser.short_circuited += result[3]
+            if result[4] is not None:
+                parser.instrument.add(result[4])
+            result = result[:3]
+        if cache is not None and result[2] is None:
+            cache.put(html, result[0], result[1])
+        yield (key,) + result
@@ -9,8 +9,8 @@ import os
 import json
 from pathlib import Path
 
-from dialogs import launch_gui
-from parsing_engine import MarkupParser
+from parsing_engine import MarkupParser, Instrument, process_documents
+from caching import ResultCache, RunManifest
 from utilities import (
     setupPrefs,
     check_for_custom_icon,
@@ -55,6 +55,8 @@ def run(bk):
         bk._w.using_automate
         and not prefs["miscellaneous_settings"]["automate_runs_headless"]
     ):
+        # The Qt stack is only loaded for GUI runs
+        from dialogs import launch_gui
 
         bailOut = launch_gui(bk, prefs)
 
@@ -78,29 +80,65 @@ def run(bk):
         if headless_prefs.exists and headless_prefs.is_file():
             with open(headless_prefs, "r", encoding="utf-8") as f:
                 criteria = json.load(f)
-            totals = 0
-            # Loop through all text files in epub
-            for ident, href in bk.text_iter():
-                # Param 1 - the contents of the (x)html file.
-                criteria["html"] = bk.readfile(ident)
-                if not isinstance(criteria["html"], str):
-                    criteria["html"] = str(criteria["html"], "utf-8")
-
-                # Hand off the "criteria" parameters dictionary to the parsing engine
-                parser = MarkupParser(criteria)
+            # Opt-in timings and counters: "instrument": true, or the name of a
+            # json file (in the plugin prefs folder) to dump them to
+            instrument = None
+            if criteria.get("instrument", False):
+                instrument = Instrument()
+            # Hand off the "criteria" parameters dictionary to the parsing engine
+            # once; the same parser is reused for every file.
+            try:
+                parser = MarkupParser(criteria, instrument)
+            except ValueError as e:
+                print("{}: {}".format("Invalid headless.json criteria", e))
+                return -1
+            # Opt-in parallel merging: "parallel": true, "jobs": N (0 = one per CPU)
+            jobs = 1
+            if criteria.get("parallel", False):
+                jobs = criteria.get("jobs", 0)
+
+            # Files as this run leaves them are recorded; with "incremental" the
+            # ones unchanged since the last run with the same criteria are skipped
+            manifest = RunManifest(headless_prefs.parent, criteria)
+
+            def read_text_files():
+                # Loop through all text files in epub
+                for ident, href in bk.text_iter():
+                    # The contents of the (x)html file.
+                    html = bk.readfile(ident)
+                    if not isinstance(html, str):
+                        html = str(html, "utf-8")
+                    if manifest.skip(href, html):
+                        continue
+                    yield (ident, href), html
+
+            # Results of earlier runs are reused unless "bypass_cache" is set
+            cache = None
+            if not criteria.get("bypass_cache", False):
+                cache = ResultCache(headless_prefs.parent, criteria)
 
-                # Retrieve the new markup and the number of occurrences changed
-                try:
-                    html, occurrences = parser.processml()
-                except Exception:
+            totals = 0
+            # Retrieve the new markup and the number of occurrences changed
+            for (ident, href), html, occurrences, error in process_documents(
+                parser, read_text_files(), jobs, cache
+            ):
+                if error is not None:
                     print("{} {}! {}.\n".format("Error parsing", href, "File skipped"))
+                    manifest.forget(href)
                     continue
 
                 # Report whether or not changes were made (and how many)
                 totals += occurrences
-                if occurrences:
+                if occurrences and parser.dry_run:
+                    print(
+                        "{} {}:   {}".format(
+                            "Occurrences that would be changed in", href, int(occurrences)
+                        )
+                    )
+                elif occurrences:
                     # write changed markup back to file
                     bk.writefile(ident, html)
+                    manifest.record(href, html)
                     print(
                         "{} {}:   {}".format(
                             "Occurrences found/changed in", href, int(occurrences)
@@ -108,6 +146,35 @@ def run(bk):
                     )
                 else:
                     print("{} {}\n".format("Criteria not found in", href))
+            if parser.dry_run:
+                print(
+                    "{}: {}".format(
+                        "Dry run - total occurrences that would be changed", totals
+                    )
+                )
+            else:
+                manifest.save()
+            if manifest.incremental:
+                print(
+                    "{}: {}".format(
+                        "Files skipped (unchanged since the last run)", manifest.skipped
+                    )
+                )
+            if parser.short_circuited:
+                print(
+                    "{}: {}".format(
+                        "Files skipped without parsing (nothing to merge)",
+                        parser.short_circuited,
+                    )
+                )
+            if cache is not None:
+                print("{}: {}".format("Results reused from cache", cache.hits))
+                cache.prune()
+            if instrument is not None:
+                for label, value in instrument.summary():
+                    print("{}: {}".format(label, value))
+                if isinstance(criteria["instrument"], str):
+                    instrument.dump(headless_prefs.parent.joinpath(criteria["instrument"]))
         else:
             print('"headless.json" file does not exist in the plugin prefs directory')
             return -1
@@ -115,7 +182,10 @@ def run(bk):
 
 
 def main():
-    return -1
+    # Outside of Sigil: merge books given on the command line
+    import cli
+
+    return cli.main()
 
 
 if __name__ == "__main__":
@@ -0,0 +1,86 @@
+# -*- coding: utf-8 -*-
+# vim:ts=4:sw=4:softtabstop=4:smarttab:expandtab
+
+"""The lxml backend must merge what the bs4 backend merges, into the same
+document (compared in canonical form, so attribute order, empty tag syntax
+and CDATA sections don't count)."""
+
+from html.entities import html5
+
+import pytest
+import regex as re
+from lxml import etree
+
+from parsing_engine import MarkupParser
+
+DOCUMENT = """<?xml version="1.0" encoding="utf-8"?>
+<html xmlns="http://www.w3.org/1999/xhtml" xmlns:epub="http://www.idpf.org/2007/ops">
+<head><title>Test</title></head>
+<body>%s</body>
+</html>"""
+
+# (id, body, criteria beyond a merge of spans with any attributes)
+CORPUS = [
+    ("plain", '<p><span class="a">one </span><span class="a">two</span><span class="b">three</span></p>', {}),
+    ("namespaced-attributes",
+     '<p><span epub:type="pagebreak" class="a">1</span><span class="a" epub:type="pagebreak">2</span>'
+     '<span epub:type="noteref" class="a">3</span></p>', {}),
+    ("comments-between-siblings",
+     '<p><span class="a">one</span><!-- between --><span class="a">two</span>'
+     '<!--a--><!--b--><span class="a">three</span></p>', {}),
+    ("cdata", '<p><span class="a"><![CDATA[x < y]]></span><span class="a">z<![CDATA[&]]></span></p>', {}),
+    ("self-closing",
+     '<p><span class="a"/><span class="a">text</span><span class="a"></span><br/><br/></p>'
+     '<div><img src="a.png"/><img src="a.png"/></div>', {}),
+    ("entities",
+     '<p title="x&nbsp;y"><span class="a">a&nbsp;&amp;</span><span class="a">b&lt;&hellip;</span>'
+     '<span class="a">&#160;&#x2014;&quot;</span></p>', {}),
+    ("nested",
+     '<div><p><i>a</i><i>b</i></p><p><i>c</i></p></div><div><p><i>d</i></p></div>', {"tag": None}),
+    ("attribute-rule",
+     '<p><span class="x1">a</span><span class="x1">b</span><span class="y">c</span><span class="y">d</span></p>',
+     {"attrib": "class", "srch_str": "x\\d", "srch_method": "regex"}),
+]
+
+_named_entity = re.compile(r"""&(?!(?:amp|lt|gt|quot|apos);)([A-Za-z][\w.-]*;)""")
+
+
+def run(body, backend, **criteria):
+    settings = {"action": "merge", "tag": "span", "attrib": None, "srch_str": None,
+                "srch_method": "normal", "backend": backend, "prefilter": False}
+    settings.update(criteria)
+    parser = MarkupParser(settings)
+    return parser.process(DOCUMENT % body)
+
+
+def c14n(html):
+    """Canonical form of a document, with its HTML entities as characters."""
+    html = _named_entity.sub(lambda m: html5[m.group(1)], html)
+    return etree.canonicalize(etree.fromstring(html.encode("utf-8")), with_comments=True)
+
+
+@pytest.mark.parametrize("body,criteria", [case[1:] for case in CORPUS], ids=[case[0] for case in CORPUS])
+def test_lxml_matches_bs4(body, criteria):
+    bs4_html, bs4_count = run(body, "bs4", **criteria)
+    lxml_html, lxml_count = run(body, "lxml", **criteria)
+    assert bs4_count > 0
+    assert lxml_count == bs4_count
+    assert c14n(lxml_html) == c14n(bs4_html)
+
+
+@pytest.mark.parametrize("backend", ["bs4", "lxml", "stream"])
+def test_entities_kept(backend):
+    html, count = run('<p><span>a&nbsp;&amp;</span><span>b&lt;</span></p>', backend)
+    assert count == 1
+    assert "<span>a&nbsp;&amp;b&lt;</span>" in html
+
+
+@pytest.mark.parametrize("body,count", [
+    ('<p><span title="&nbsp;">a</span><span title="&nbsp;">b</span></p>', 1),
+    ('<p><span title="&nbsp;">a</span><span title="&#160;">b</span></p>', 0),
+    ('<p><span title="a&amp;b">a</span><span title="a&#38;b">b</span></p>', 1),
+])
+def test_attribute_entities(body, count):
+    # Every backend compares attribute values the same way
+    for backend in ("bs4", "lxml", "stream"):
+        assert run(body, backend)[1] == count, backend
@@ -0,0 +1,29 @@
+# -*- coding: utf-8 -*-
+# vim:ts=4:sw=4:softtabstop=4:smarttab:expandtab
+
+import json
+
+import benchmark
+
+
+def test_check(tmp_path):
+    report = tmp_path / "bench.json"
+    argv = ["--files", "3", "--size", "4", "--check", "-o", str(report)]
+    assert benchmark.main(argv) == 0
+    results = json.loads(report.read_text(encoding="utf-8"))["results"]
+    assert [(r["backend"], r["engine"]) for r in results] == benchmark.CONFIGS
+    assert len(set(r["occurrences"] for r in results)) == 1
+    assert results[0]["occurrences"] > 0
+    for result in results:
+        assert result["counters"]["merges"] == result["occurrences"]
+        assert result["phases"]
+
+
+def test_dry_run(tmp_path):
+    report = tmp_path / "bench.json"
+    argv = ["--files", "3", "--size", "4", "--dry-run", "--config", "bs4:classic", "--config", "lxml", "-o", str(report)]
+    assert benchmark.main(argv) == 0
+    results = json.loads(report.read_text(encoding="utf-8"))["results"]
+    # Dry runs count on the token stream whatever the configuration
+    assert all(list(r["phases"]) == ["stream"] for r in results)
+    assert results[0]["occurrences"] == results[1]["occurrences"] > 0
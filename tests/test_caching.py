@@ -0,0 +1,58 @@
+# -*- coding: utf-8 -*-
+# vim:ts=4:sw=4:softtabstop=4:smarttab:expandtab
+
+from caching import ResultCache, RunManifest, criteria_digest
+
+# What the GUI's validate() hands the engine
+GUI = {
+    "action": "merge", "tag": "span", "attrib": "class", "srch_str": "calibre\\d+", "srch_method": "regex",
+    "no_select": False, "bypass_cache": False, "instrument": False, "incremental": True, "dry_run": False,
+}
+# The same criteria saved to headless.json (without the run-only flags), plus
+# keys set by hand to their defaults
+HEADLESS = {
+    "action": "merge", "tag": "span", "attrib": "class", "srch_str": "calibre\\d+", "srch_method": "regex",
+    "no_select": False, "bypass_cache": False, "incremental": True,
+    "engine": "classic", "backend": "bs4", "output": "serialise", "class_as_set": False, "coalesce_text": False,
+}
+
+
+def test_defaults_normalised():
+    assert criteria_digest(GUI) == criteria_digest(HEADLESS)
+    assert criteria_digest(dict(GUI, jobs=4, prefilter=False)) == criteria_digest(HEADLESS)
+
+
+def test_results_affecting_criteria():
+    digest = criteria_digest(GUI)
+    assert criteria_digest(dict(GUI, dry_run=True)) != digest
+    assert criteria_digest(dict(GUI, engine="linear")) != digest
+    assert criteria_digest(dict(GUI, class_as_set=True)) != digest
+    assert criteria_digest(dict(GUI, srch_str="calibre")) != digest
+
+
+def test_rules_normalised():
+    rules = {"action": "merge", "rules": [{"tag": "i"}, {"tag": "b", "srch_method": "normal"}]}
+    spelt_out = {
+        "action": "merge", "tag": "span", "attrib": None, "srch_str": None, "srch_method": "normal",
+        "rules": [{"tag": "i", "attrib": None, "srch_str": None}, {"tag": "b"}],
+    }
+    assert criteria_digest(rules) == criteria_digest(spelt_out)
+    assert criteria_digest(rules) != criteria_digest(dict(rules, rules=[{"tag": "b"}, {"tag": "i"}]))
+
+
+def test_cache_shared(tmp_path):
+    gui = ResultCache(str(tmp_path), GUI)
+    gui.put("<p/>", "<p>merged</p>", 2)
+    headless = ResultCache(str(tmp_path), HEADLESS)
+    assert headless.get("<p/>") == ("<p>merged</p>", 2)
+    assert ResultCache(str(tmp_path), dict(GUI, dry_run=True)).get("<p/>") is None
+
+
+def test_manifest_shared(tmp_path):
+    gui = RunManifest(str(tmp_path), GUI)
+    assert not gui.skip("Text/a.xhtml", "<p/>")
+    gui.record("Text/a.xhtml", "<p>merged</p>")
+    gui.save()
+    headless = RunManifest(str(tmp_path), HEADLESS)
+    assert headless.skip("Text/a.xhtml", "<p>merged</p>")
+    assert not headless.skip("Text/b.xhtml", "<p/>")
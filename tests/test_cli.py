@@ -0,0 +1,132 @@
+# -*- coding: utf-8 -*-
+# vim:ts=4:sw=4:softtabstop=4:smarttab:expandtab
+
+import os
+import json
+import struct
+import zipfile
+
+import pytest
+
+import cli
+
+CRITERIA = {"action": "merge", "tag": "span", "attrib": None, "srch_str": None, "srch_method": "normal"}
+
+DOCUMENT = (
+    '<?xml version="1.0" encoding="utf-8"?>\r\n'
+    '<html xmlns="http://www.w3.org/1999/xhtml">\r\n'
+    "<body>\r\n<p><span>one\r\n</span><span>two</span></p>\r\n</body>\r\n</html>\r\n"
+)
+
+CONTAINER = """<?xml version="1.0"?>
+<container version="1.0" xmlns="urn:oasis:names:tc:opendocument:xmlns:container">
+<rootfiles><rootfile full-path="OEBPS/content.opf" media-type="application/oebps-package+xml"/></rootfiles>
+</container>"""
+
+OPF = """<?xml version="1.0" encoding="utf-8"?>
+<package xmlns="http://www.idpf.org/2007/opf" version="2.0"><manifest>
+<item id="a" href="Text/a.xhtml" media-type="application/xhtml+xml"/>
+<item id="b" href="Text/b%20b.xhtml" media-type="application/xhtml+xml"/>
+<item id="css" href="Styles/s.css" media-type="text/css"/>
+</manifest></package>"""
+
+# name, data, compression (compresslevel 1, so that recompressing would give
+# other bytes); mimetype is not first, and not stored, in the source
+MEMBERS = [
+    ("META-INF/container.xml", CONTAINER, zipfile.ZIP_DEFLATED),
+    ("mimetype", "application/epub+zip", zipfile.ZIP_DEFLATED),
+    ("OEBPS/content.opf", OPF, zipfile.ZIP_DEFLATED),
+    ("OEBPS/Text/a.xhtml", DOCUMENT, zipfile.ZIP_DEFLATED),
+    ("OEBPS/Text/b b.xhtml", DOCUMENT.replace("</span><span>", " "), zipfile.ZIP_STORED),
+    ("OEBPS/Styles/s.css", "span { color: red }\n" * 50, zipfile.ZIP_DEFLATED),
+    ("OEBPS/Images/x.png", "\x89PNG" + "\x00" * 64, zipfile.ZIP_STORED),
+]
+
+
+def raw_member(path, info):
+    """Compressed bytes of a zip member, read through its local header."""
+    with open(path, "rb") as f:
+        f.seek(info.header_offset + 26)
+        name_length, extra_length = struct.unpack("<HH", f.read(4))
+        f.seek(name_length + extra_length, os.SEEK_CUR)
+        return f.read(info.compress_size)
+
+
+def use_pool(monkeypatch):
+    """Have --jobs 2 start worker processes whatever the number of CPUs
+    here. Returns the pools started."""
+    pools = []
+
+    def worker_pool(parser, jobs):
+        with monkeypatch.context() as patch:
+            patch.setattr(os, "cpu_count", lambda: 2)
+            pools.append(real_pool(parser, jobs))
+        return pools[-1]
+
+    real_pool = cli.worker_pool
+    monkeypatch.setattr(cli, "worker_pool", worker_pool)
+    return pools
+
+
+def test_folder_keeps_line_endings(tmp_path):
+    criteria = tmp_path / "headless.json"
+    criteria.write_text(json.dumps(dict(CRITERIA, backend="stream")), encoding="utf-8")
+    book = tmp_path / "book"
+    book.mkdir()
+    (book / "text.xhtml").write_bytes(DOCUMENT.encode("utf-8"))
+    assert cli.main(["--criteria", str(criteria), str(book)]) == 0
+    assert (book / "text.xhtml").read_bytes() == DOCUMENT.replace("</span><span>", "").encode("utf-8")
+
+
+def test_books_share_pool(tmp_path, capsys, monkeypatch):
+    pools = use_pool(monkeypatch)
+    criteria = tmp_path / "headless.json"
+    criteria.write_text(json.dumps(CRITERIA), encoding="utf-8")
+    books = []
+    for n in range(3):
+        book = tmp_path / "book{}".format(n)
+        book.mkdir()
+        for m in range(n + 1):
+            (book / "text{}.xhtml".format(m)).write_bytes(DOCUMENT.encode("utf-8"))
+        books.append(str(book))
+    outputs = {}
+    for jobs in ("1", "2"):
+        output = tmp_path / "out{}".format(jobs)
+        assert cli.main(["--criteria", str(criteria), "--jobs", jobs, "--output", str(output)] + books) == 0
+        outputs[jobs] = sorted((path.relative_to(output), path.read_bytes()) for path in output.rglob("*.xhtml"))
+        assert "Total occurrences found/changed: 6" in capsys.readouterr().out
+    assert pools[0] is None and pools[1] is not None
+    assert len(outputs["2"]) == 6
+    assert outputs["2"] == outputs["1"]
+
+
+@pytest.mark.parametrize("jobs", ["1", "2"])
+def test_epub_round_trip(tmp_path, capsys, monkeypatch, jobs):
+    pools = use_pool(monkeypatch)
+    criteria = tmp_path / "headless.json"
+    criteria.write_text(json.dumps(dict(CRITERIA, backend="stream")), encoding="utf-8")
+    source = tmp_path / "book.epub"
+    with zipfile.ZipFile(str(source), "w") as book:
+        for name, data, compression in MEMBERS:
+            book.writestr(name, data.encode("utf-8"), compression, compresslevel=1)
+    output = tmp_path / "out"
+    assert cli.main(["--criteria", str(criteria), "--jobs", jobs, "--output", str(output), str(source)]) == 0
+    assert "Total occurrences found/changed: 1" in capsys.readouterr().out
+    assert (pools[0] is not None) == (jobs == "2")
+
+    merged = output / "book.epub"
+    with zipfile.ZipFile(str(source)) as src, zipfile.ZipFile(str(merged)) as out:
+        assert out.testzip() is None
+        infos = out.infolist()
+        assert infos[0].filename == "mimetype"
+        assert infos[0].compress_type == zipfile.ZIP_STORED
+        assert sorted(out.namelist()) == sorted(src.namelist())
+        assert out.read("OEBPS/Text/a.xhtml") == DOCUMENT.replace("</span><span>", "").encode("utf-8")
+        for info in infos[1:]:
+            if info.filename == "OEBPS/Text/a.xhtml":
+                continue
+            # Copied as stored, not recompressed
+            original = src.getinfo(info.filename)
+            assert info.compress_type == original.compress_type
+            assert info.CRC == original.CRC
+            assert raw_member(str(merged), info) == raw_member(str(source), original)
@@ -0,0 +1,77 @@
+# -*- coding: utf-8 -*-
+# vim:ts=4:sw=4:softtabstop=4:smarttab:expandtab
+
+"""Dry runs count on the token stream; the counts must be those of a real
+run with whatever engine and backend are configured."""
+
+import random
+
+import pytest
+
+from parsing_engine import MarkupParser
+
+DOCUMENT = """<?xml version="1.0" encoding="utf-8"?>
+<html xmlns="http://www.w3.org/1999/xhtml" xmlns:m="http://www.w3.org/1998/Math/MathML">
+<head><title>Test</title></head>
+<body>%s</body>
+</html>"""
+
+CONFIGS = [
+    {"engine": "classic"},
+    {"engine": "linear"},
+    {"engine": "postorder"},
+    {"engine": "classic", "class_as_set": True},
+    {"backend": "lxml"},
+    {"backend": "stream"},
+    {"output": "patch"},
+]
+
+TAGS = ["span", "i", "m:span"]
+ATTRIBUTES = ["", ' class="a"', ' class="b a"', ' class="a b"', ' title="x > y"']
+
+
+def fragment(rng, depth):
+    out = []
+    for _ in range(rng.randint(0, 4)):
+        r = rng.random()
+        if r < 0.2:
+            out.append(rng.choice(["x", " ", "a &amp; b&nbsp;"]))
+        elif r < 0.3:
+            out.append(rng.choice(["<!--c-->", "<![CDATA[<i>]]>"]))
+        elif r < 0.45:
+            out.append("<{}{}/>".format(rng.choice(TAGS), rng.choice(ATTRIBUTES)))
+        elif depth < 3:
+            tag = rng.choice(TAGS)
+            out.append("<{0}{1}>{2}</{0}>".format(tag, rng.choice(ATTRIBUTES), fragment(rng, depth + 1)))
+    return "".join(out)
+
+
+def counts(html, config, **criteria):
+    settings = {"action": "merge", "tag": None, "attrib": None, "srch_str": None, "srch_method": "normal"}
+    settings.update(criteria)
+    settings.update(config)
+    real = MarkupParser(settings).process(html)
+    dry = MarkupParser(dict(settings, dry_run=True)).process(html)
+    assert dry[0] is None
+    return dry[1], real[1]
+
+
+@pytest.mark.parametrize("config", CONFIGS, ids=lambda config: "-".join(str(v) for v in config.values()))
+def test_counts_match(config):
+    rng = random.Random(1)
+    for _ in range(80):
+        html = DOCUMENT % "<p>{}</p><div>{}</div>".format(fragment(rng, 0), fragment(rng, 0))
+        for criteria in ({}, {"tag": "span", "attrib": "class", "srch_str": "a.*", "srch_method": "regex"}):
+            dry, real = counts(html, config, **criteria)
+            assert dry == real, (criteria, html)
+
+
+def test_no_tree(monkeypatch):
+    def parse(self):
+        raise AssertionError("dry run parsed the document")
+
+    monkeypatch.setattr(MarkupParser, "parse", parse)
+    html = DOCUMENT % "<p><span>a</span><span>b</span></p>"
+    parser = MarkupParser({"action": "merge", "tag": "span", "attrib": None, "srch_str": None,
+                           "srch_method": "normal", "dry_run": True})
+    assert parser.process(html) == (None, 1)
@@ -0,0 +1,78 @@
+# -*- coding: utf-8 -*-
+# vim:ts=4:sw=4:softtabstop=4:smarttab:expandtab
+
+"""output: patch must give exactly the stream backend's markup."""
+
+import random
+
+import pytest
+
+from parsing_engine import MarkupParser
+
+DOCUMENT = """<?xml version="1.0" encoding="utf-8"?>
+<html xmlns="http://www.w3.org/1999/xhtml" xmlns:m="http://www.w3.org/1998/Math/MathML">
+<head><title>Test</title></head>
+<body>%s</body>
+</html>"""
+
+CASES = [
+    '<p><span class="a">one</span> <span class="a">two</span><span class="b">three</span></p>',
+    '<p><m:span>a</m:span><span>b</span></p>',
+    '<p><span/><m:span>c</m:span></p>',
+    '<p><span>a</span><m:span/>x<m:span>b</m:span><!--c--><span>d</span></p>',
+    '<p><span class="a"/> <span class="a"/><span class="a">t</span></p>',
+    '<div><p><i>a</i></p><p><i>b</i>x</p><p>y<i>c</i></p></div>',
+    '<p><span title="x > y">a&nbsp;</span><span title="x > y"><![CDATA[<b>]]></span></p>',
+]
+
+TAGS = ["span", "i", "m:span", "m:i"]
+ATTRIBUTES = ["", ' class="a"', ' class="b"']
+
+
+def fragment(rng, depth):
+    out = []
+    for _ in range(rng.randint(0, 4)):
+        r = rng.random()
+        if r < 0.2:
+            out.append(rng.choice(["x", " ", "a &amp; b", "\n"]))
+        elif r < 0.3:
+            out.append(rng.choice(["<!--c-->", "<![CDATA[<i>]]>"]))
+        elif r < 0.45:
+            out.append("<{}{}/>".format(rng.choice(TAGS), rng.choice(ATTRIBUTES)))
+        elif depth < 3:
+            tag = rng.choice(TAGS)
+            out.append("<{0}{1}>{2}</{0}>".format(tag, rng.choice(ATTRIBUTES), fragment(rng, depth + 1)))
+    return "".join(out)
+
+
+def outputs(html, **criteria):
+    settings = {"action": "merge", "tag": "span", "attrib": None, "srch_str": None,
+                "srch_method": "normal", "html": html, "prefilter": False}
+    settings.update(criteria)
+    stream = MarkupParser(dict(settings, backend="stream")).processml()
+    patch = MarkupParser(dict(settings, output="patch")).processml()
+    return stream, patch
+
+
+@pytest.mark.parametrize("body", CASES)
+def test_cases(body):
+    stream, patch = outputs(DOCUMENT % body, tag=None)
+    assert stream[1] > 0
+    assert patch == stream
+
+
+def test_prefixed_siblings():
+    stream, patch = outputs(DOCUMENT % CASES[1])
+    assert "<m:span>ab</m:span>" in patch[0]
+    stream, patch = outputs(DOCUMENT % CASES[2])
+    assert "<span>c</span>" in patch[0]
+
+
+@pytest.mark.parametrize("seed", range(3))
+def test_random_documents(seed):
+    rng = random.Random(seed)
+    for _ in range(60):
+        html = DOCUMENT % "<p>{}</p><div>{}</div>".format(fragment(rng, 0), fragment(rng, 0))
+        for criteria in ({"tag": "span"}, {"tag": None}, {"rules": [{"tag": "i"}, {"tag": "span", "attrib": "class", "srch_str": "a"}]}):
+            stream, patch = outputs(html, **criteria)
+            assert patch == stream, (criteria, html)
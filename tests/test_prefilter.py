@@ -0,0 +1,74 @@
+# -*- coding: utf-8 -*-
+# vim:ts=4:sw=4:softtabstop=4:smarttab:expandtab
+
+"""The prefilter may only skip documents with nothing to merge: counts with
+it must equal counts without it."""
+
+import random
+
+import pytest
+
+from parsing_engine import MarkupParser
+
+DOCUMENT = """<?xml version="1.0" encoding="utf-8"?>
+<html xmlns="http://www.w3.org/1999/xhtml" xmlns:m="http://www.w3.org/1998/Math/MathML">
+<head><title>Test</title></head>
+<body>%s</body>
+</html>"""
+
+CASES = [
+    ("img", '<p><img alt="x > y" src="a.png"/><img alt="x > y" src="a.png"/></p>'),
+    ("span", '<p><span title="a>b"/><span title="a>b"></span></p>'),
+    ("span", "<p><span title='a>b' class=\"c\"/><!--x--><span title='a>b' class=\"c\">t</span></p>"),
+    ("span", '<p><span class="a">x</span> <![CDATA[<b>]]><span class="a">y</span></p>'),
+    ("span", '<p><m:span>a</m:span><span>b</span></p>'),
+    ("span", '<p><span>a</span><b>b</b><span>c</span></p>'),
+    ("i", '<p><i>a</i><i title="1">b</i></p>'),
+]
+
+TAGS = ["span", "i", "m:span"]
+ATTRIBUTES = ["", ' class="a"', ' title="a>b"', " title='x > y'", ' alt="/>"']
+
+
+def fragment(rng, depth):
+    out = []
+    for _ in range(rng.randint(0, 4)):
+        r = rng.random()
+        if r < 0.2:
+            out.append(rng.choice(["x", " ", "a &gt; b", "1 > 0"]))
+        elif r < 0.3:
+            out.append(rng.choice(["<!--c-->", "<![CDATA[<i>]]>", "<?pi x?>"]))
+        elif r < 0.5:
+            out.append("<{}{}/>".format(rng.choice(TAGS), rng.choice(ATTRIBUTES)))
+        elif depth < 3:
+            tag = rng.choice(TAGS)
+            out.append("<{0}{1}>{2}</{0}>".format(tag, rng.choice(ATTRIBUTES), fragment(rng, depth + 1)))
+    return "".join(out)
+
+
+def count(html, tag, prefilter, **criteria):
+    settings = {"action": "merge", "tag": tag, "attrib": None, "srch_str": None,
+                "srch_method": "normal", "prefilter": prefilter}
+    settings.update(criteria)
+    return MarkupParser(settings).process(html)[1]
+
+
+@pytest.mark.parametrize("tag,body", CASES)
+def test_cases(tag, body):
+    html = DOCUMENT % body
+    assert count(html, tag, True) == count(html, tag, False)
+
+
+def test_attribute_with_greater_than():
+    html = DOCUMENT % CASES[0][1]
+    assert count(html, "img", True) == 1
+
+
+@pytest.mark.parametrize("seed", range(3))
+def test_random_documents(seed):
+    rng = random.Random(seed)
+    for _ in range(60):
+        html = DOCUMENT % "<p>{}</p><div>{}</div>".format(fragment(rng, 0), fragment(rng, 0))
+        for tag in ("span", "i", None):
+            assert count(html, tag, True) == count(html, tag, False), (tag, html)
+        assert count(html, "span", True, attrib="title", srch_str="a>b") == count(html, "span", False, attrib="title", srch_str="a>b")
@@ -0,0 +1,31 @@
+# -*- coding: utf-8 -*-
+# vim:ts=4:sw=4:softtabstop=4:smarttab:expandtab
+
+import pytest
+
+from parsing_engine import MarkupParser, MergeRule
+
+
+def test_from_dict_defaults():
+    rule = MergeRule.from_dict({})
+    assert (rule.tag, rule.attrib, rule.srch_str, rule.srch_method, rule.matcher) == (None, None, None, "normal", None)
+    rule = MergeRule.from_dict({"tag": "span", "attrib": "class", "srch_str": "c\\d", "srch_method": "regex"})
+    assert rule.matcher("c1") and not rule.matcher("d1")
+
+
+@pytest.mark.parametrize("rule", [
+    "span",
+    {"tag": "span", "atrib": "class", "srch_str": "a"},
+    {"tag": "span", "attrib": "class"},
+    {"tag": "span", "attrib": "class", "srch_str": None},
+    {"tag": "span", "attrib": "class", "srch_str": "a", "srch_method": "glob"},
+    {"tag": "span", "srch_method": None},
+])
+def test_from_dict_rejects(rule):
+    with pytest.raises(ValueError):
+        MergeRule.from_dict(rule)
+
+
+def test_parser_rejects_bad_rules():
+    with pytest.raises(ValueError):
+        MarkupParser({"action": "merge", "rules": [{"tag": "i"}, {"tag": "b", "method": "regex"}]})
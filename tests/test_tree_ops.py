@@ -0,0 +1,129 @@
+# -*- coding: utf-8 -*-
+# vim:ts=4:sw=4:softtabstop=4:smarttab:expandtab
+
+"""move_contents and join_strings relink whole runs of bs4 nodes at once;
+every case must leave a tree check_tree finds sound, and the markup the
+one-node-at-a-time bs4 calls would."""
+
+from parsing_engine import BeautifulSoup, MarkupParser, NavigableString, check_tree, join_strings, move_contents
+
+
+def soup_of(markup):
+    return BeautifulSoup(markup, "xml")
+
+
+def merge_all(soup, name="a"):
+    """Merge every <name> into the first one, checking the tree after each."""
+    tags = soup.find_all(name)
+    for tag in tags[1:]:
+        move_contents(tag, tags[0])
+        assert check_tree(soup) == []
+    return soup
+
+
+def body(soup):
+    return str(soup).split("?>", 1)[1].strip()
+
+
+def test_sound_parse():
+    assert check_tree(soup_of("<r><a>x<b>y</b></a><!--c--><a/>z</r>")) == []
+
+
+def test_broken_links_reported():
+    soup = soup_of("<r><a>x</a><a>y</a></r>")
+    first, second = soup.find_all("a")
+    first.next_sibling = None
+    second.contents[0].previous_element = None
+    assert check_tree(soup) == ["<a> has the wrong next_sibling", "'y' has the wrong previous_element"]
+
+
+def test_empty_target():
+    soup = merge_all(soup_of("<r><a/><a>x<b>y</b></a><p>after</p></r>"))
+    assert body(soup) == "<r><a>x<b>y</b></a><p>after</p></r>"
+
+
+def test_empty_source():
+    soup = merge_all(soup_of("<r><a>x<b>y</b></a><a/><p>after</p></r>"))
+    assert body(soup) == "<r><a>x<b>y</b></a><p>after</p></r>"
+
+
+def test_both_empty():
+    soup = merge_all(soup_of("<r><a/><a></a>z</r>"))
+    assert body(soup) == "<r><a/>z</r>"
+
+
+def test_strings_between():
+    soup = merge_all(soup_of("<r><a>x</a> and <a>y</a>.</r>"))
+    assert body(soup) == "<r><a>xy</a> and .</r>"
+
+
+def test_comment_between():
+    soup = merge_all(soup_of("<r><a>x</a><!--c--> <a><b>y</b></a><p/></r>"))
+    assert body(soup) == "<r><a>x<b>y</b></a><!--c--> <p/></r>"
+
+
+def test_nested_last_descendants():
+    soup = merge_all(soup_of("<r><p><a><b><i>x</i></b></a><a><b><i>y</i></b></a></p><p>after</p></r>"))
+    assert body(soup) == "<r><p><a><b><i>x</i></b><b><i>y</i></b></a></p><p>after</p></r>"
+
+
+def test_source_ends_document():
+    # Nothing follows the source's subtree: the moved run ends the chain
+    soup = merge_all(soup_of("<r><a>x</a><a><b>y</b></a></r>"))
+    assert body(soup) == "<r><a>x<b>y</b></a></r>"
+
+
+def test_run_of_merges():
+    soup = merge_all(soup_of("<r><p><a>1</a><a/><a><b>2</b></a> <a>3<i>4</i></a><!--c--><a>5</a></p><p/></r>"))
+    assert body(soup) == "<r><p><a>1<b>2</b>3<i>4</i>5</a> <!--c--></p><p/></r>"
+
+
+def test_matches_append():
+    markup = "<r><p><a>x<b>y</b></a> <a>z<i>w</i></a><a/><a>v</a></p><p>after</p></r>"
+    soup = merge_all(soup_of(markup))
+    reference = soup_of(markup)
+    tags = reference.find_all("a")
+    for tag in tags[1:]:
+        for child in list(tag.contents):
+            tags[0].append(child)
+        tag.decompose()
+    assert str(soup) == str(reference)
+    assert [str(node) for node in soup.descendants] == [str(node) for node in reference.descendants]
+
+
+def test_join_strings():
+    soup = merge_all(soup_of("<r><a>x</a><a>y</a><a>z<b>w</b></a><a>v</a></r>"))
+    tag = soup.a
+    assert join_strings(tag) == 2
+    assert check_tree(soup) == []
+    assert [str(node) for node in tag.contents] == ["xyz", "<b>w</b>", "v"]
+    assert type(tag.contents[0]) is NavigableString
+    assert body(soup) == "<r><a>xyz<b>w</b>v</a></r>"
+
+
+def test_join_strings_keeps_comments():
+    soup = merge_all(soup_of("<r><a>x</a><a>y<!--c--></a><a>z</a><a>v</a></r>"))
+    tag = soup.a
+    assert join_strings(tag) == 2
+    assert check_tree(soup) == []
+    assert [str(node) for node in tag.contents] == ["xy", "c", "zv"]
+    assert type(tag.contents[1]) is not NavigableString
+    assert body(soup) == "<r><a>xy<!--c-->zv</a></r>"
+
+
+def test_join_strings_nothing_to_join():
+    soup = soup_of("<r><a>x<!--c-->y<b/>z</a></r>")
+    assert join_strings(soup.a) == 0
+    assert check_tree(soup) == []
+    assert body(soup) == "<r><a>x<!--c-->y<b/>z</a></r>"
+
+
+def test_coalesce_text():
+    markup = "<r><p><a>1</a><a>2</a>, <a>3</a><!--c--><a>4</a></p></r>"
+    criteria = {"action": "merge", "tag": "a", "attrib": None, "srch_str": None, "srch_method": "normal"}
+    parser = MarkupParser(dict(criteria, html=markup, coalesce_text=True))
+    soup = parser.merge(parser.parse())
+    assert check_tree(soup) == []
+    assert [str(node) for node in soup.p.a.contents] == ["1234"]
+    assert [str(node) for node in soup.p.contents] == ["<a>1234</a>", ", ", "c"]
+    assert parser.serialise(soup) == MarkupParser(dict(criteria, html=markup)).processml()[0]
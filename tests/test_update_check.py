@@ -0,0 +1,104 @@
+# -*- coding: utf-8 -*-
+# vim:ts=4:sw=4:softtabstop=4:smarttab:expandtab
+
+import os
+import re
+import shutil
+import threading
+from datetime import datetime, timedelta
+from functools import partial
+from http.server import SimpleHTTPRequestHandler, ThreadingHTTPServer
+
+import pytest
+
+from utilities import UpdateChecker, tuple_version
+
+REPO = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+
+class QuietHandler(SimpleHTTPRequestHandler):
+    def log_message(self, *args):
+        pass
+
+
+class Wrapper(object):
+    """Stand-in for bk._w: where plugin.xml is installed."""
+
+    def __init__(self, plugin_dir, plugin_name):
+        self.plugin_dir = plugin_dir
+        self.plugin_name = plugin_name
+
+
+@pytest.fixture
+def site(tmp_path):
+    """Folder served over http on localhost; yields (folder, base url)."""
+    folder = tmp_path / "site"
+    folder.mkdir()
+    server = ThreadingHTTPServer(("127.0.0.1", 0), partial(QuietHandler, directory=str(folder)))
+    thread = threading.Thread(target=server.serve_forever, kwargs={"poll_interval": 0.05}, daemon=True)
+    thread.start()
+    yield folder, "http://127.0.0.1:{}/".format(server.server_port)
+    server.shutdown()
+    server.server_close()
+    thread.join()
+
+
+@pytest.fixture
+def w(tmp_path):
+    os.makedirs(str(tmp_path / "plugins" / "MergeAdjacentTag"))
+    shutil.copy(os.path.join(REPO, "plugin.xml"), str(tmp_path / "plugins" / "MergeAdjacentTag"))
+    return Wrapper(str(tmp_path / "plugins"), "MergeAdjacentTag")
+
+
+def publish(folder, version=None):
+    """Serve the repository's checkversion.xml, announcing version if given."""
+    with open(os.path.join(REPO, "checkversion.xml"), "r", encoding="utf-8") as f:
+        data = f.read()
+    if version is not None:
+        data = re.sub(r"<current-version>[^<]*</current-version>", "<current-version>{}</current-version>".format(version), data)
+    (folder / "checkversion.xml").write_text(data, encoding="utf-8")
+
+
+def checker(base_url, w, hours_ago=13, seen="0.0.0"):
+    last = str(datetime.now() - timedelta(hours=hours_ago))
+    return UpdateChecker(last, seen, w, check_url=base_url + "checkversion.xml")
+
+
+def newer_than_installed(w):
+    installed = checker("http://127.0.0.1:9/", w).get_current_version()
+    return ".".join(str(n + 1 if i == 0 else n) for i, n in enumerate(tuple_version(installed)))
+
+
+def test_newer_version(site, w):
+    folder, base_url = site
+    newer = newer_than_installed(w)
+    publish(folder, newer)
+    update, online, checked = checker(base_url, w).update_info()
+    assert (update, online) == (True, newer)
+    assert datetime.now() - datetime.strptime(checked, "%Y-%m-%d %H:%M:%S.%f") < timedelta(minutes=1)
+
+
+def test_current_version(site, w):
+    folder, base_url = site
+    publish(folder)
+    current = checker(base_url, w).get_current_version()
+    assert checker(base_url, w).get_online_version() == current
+    assert checker(base_url, w).update_info()[:2] == (False, current)
+
+
+def test_newer_version_already_seen(site, w):
+    folder, base_url = site
+    newer = newer_than_installed(w)
+    publish(folder, newer)
+    assert checker(base_url, w, seen=newer).update_info()[:2] == (False, newer)
+
+
+def test_checked_recently(site, w):
+    folder, base_url = site
+    publish(folder, newer_than_installed(w))
+    assert checker(base_url, w, hours_ago=1).update_info()[:2] == (False, None)
+
+
+def test_unreachable(w):
+    # Nothing listens on the discard port: no version, no update
+    assert checker("http://127.0.0.1:9/", w).update_info()[:2] == (False, None)
@@ -10,6 +10,7 @@ import os
 import sys
 import socket
 from datetime import datetime, timedelta
+from urllib.parse import urlsplit
 from lxml import objectify
 
 
@@ -39,6 +40,8 @@ miscellaneous_settings = {
 update_settings = {
     "last_time_checked": str(datetime.now() - timedelta(hours=13)),
     "last_online_version": "0.0.0",
+    # Where checkversion.xml is fetched from (None: the plugin's github repository)
+    "update_url": None,
 }
 
 # To add a new tag, add it to taglist and add a list of tags it can be changed to to combobox_defaults
@@ -211,15 +214,15 @@ def string_to_date(datestring):
 class UpdateChecker:
     """
     self.delta              : How often to check -- in hours
-    self.url                : url to github xml file
+    self.url                : url to github xml file (or a stand-in, e.g. a local test server)
     self.lasttimechecked    : 'stringified' datetime object of last check
     self.lastonlineversion  : version string of last online version retrieved/stored
     self.w                  : bk._w from plugin.py
     """
 
-    def __init__(self, lasttimechecked, lastonlineversion, w):
+    def __init__(self, lasttimechecked, lastonlineversion, w, check_url=None):
         self.delta = delta
-        self.url = url
+        self.url = check_url or url
         self.lasttimechecked = string_to_date(
             lasttimechecked
         )  # back to datetieme object
@@ -228,9 +231,10 @@ class UpdateChecker:
 
     def is_connected(self):
         try:
-            # connect to the host -- tells us if the host is reachable
-            # 8.8.8.8 is a Google nameserver
-            sock = socket.create_connection(("8.8.8.8", 53), 1)
+            # connect to the url's host -- tells us quickly if it is reachable
+            parts = urlsplit(self.url)
+            port = parts.port or (443 if parts.scheme == "https" else 80)
+            sock = socket.create_connection((parts.hostname, port), 1)
             sock.close()
             return True
         except Exception: